@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import argparse
+import os
+import time
+
+from pddlstream.algorithms.downward import parse_sequential_domain, parse_problem, task_from_domain_problem, \
+    normalize, instantiate
+from pddlstream.algorithms.instantiate_task import instantiate_domain, GROUNDING_FROM_OPERATOR
+from pddlstream.utils import read, elapsed_time
+
+# Compares the pure-Python grounding (instantiate_domain) with FastDownward's explore on the bundled PDDL examples
+# instantiate_domain requires every operator parameter to appear in a static precondition
+
+EXAMPLES_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
+
+##################################################
+
+def get_pddl_pairs(root=EXAMPLES_PATH):
+    pairs = []
+    for directory, _, filenames in sorted(os.walk(root)):
+        domains = sorted(f for f in filenames if f.startswith('domain') and f.endswith('.pddl'))
+        problems = sorted(f for f in filenames if f.startswith('problem') and f.endswith('.pddl'))
+        if len(domains) == 1:
+            pairs.extend((os.path.join(directory, domains[0]), os.path.join(directory, problem))
+                         for problem in problems)
+    return pairs
+
+def load_task(domain_path, problem_path):
+    domain = parse_sequential_domain(read(domain_path))
+    problem = parse_problem(domain, read(problem_path))
+    task = task_from_domain_problem(domain, problem)
+    normalize.normalize(task)
+    return task
+
+def time_grounding(ground_fn, domain_path, problem_path, num_trials=3):
+    # Returns the minimum runtime and the number of (actions, axioms)
+    runtimes = []
+    sizes = None
+    for _ in range(num_trials):
+        task = load_task(domain_path, problem_path) # Each grounding receives a fresh task
+        GROUNDING_FROM_OPERATOR.clear() # Times grounding from scratch
+        start_time = time.time()
+        try:
+            _, _, actions, axioms = ground_fn(task)[:4]
+        except NotImplementedError as e:
+            return None, str(e)
+        runtimes.append(elapsed_time(start_time))
+        sizes = (len(actions), len(axioms))
+    return min(runtimes), sizes
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num_trials', type=int, default=3, help='The number of groundings per problem')
+    args = parser.parse_args()
+    print('Arguments:', args)
+
+    groundings = [
+        ('explore', instantiate.explore),
+        ('instantiate_domain', instantiate_domain),
+    ]
+    for domain_path, problem_path in get_pddl_pairs():
+        print('\nProblem:', os.path.relpath(problem_path, EXAMPLES_PATH))
+        for name, ground_fn in groundings:
+            runtime, sizes = time_grounding(ground_fn, domain_path, problem_path, num_trials=args.num_trials)
+            if runtime is None:
+                print('{:>20} | Unsupported: {}'.format(name, sizes))
+            else:
+                print('{:>20} | Time: {:.3f} | Actions: {} | Axioms: {}'.format(name, runtime, *sizes))
+
+if __name__ == '__main__':
+    main()
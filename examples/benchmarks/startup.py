@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+# Measures the time to import the PDDLStream modules in a fresh interpreter
+# Importing should neither locate the FastDownward build nor load its translator
+
+MODULES = [
+    'pddlstream.algorithms.downward',
+    'pddlstream.algorithms.meta',
+]
+
+TRANSLATOR_MODULES = ['pddl', 'pddl_parser', 'instantiate', 'normalize', 'translate']
+
+CHECK_TEMPLATE = """
+import sys
+import {module}
+loaded = [name for name in {translator_modules} if name in sys.modules]
+assert not loaded, 'Translator modules loaded upon import: {{}}'.format(loaded)
+"""
+
+ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+
+##################################################
+
+def time_import(module, num_trials=10):
+    command = [sys.executable, '-c', CHECK_TEMPLATE.format(
+        module=module, translator_modules=TRANSLATOR_MODULES)]
+    baseline_command = [sys.executable, '-c', 'pass']
+    runtimes = []
+    for _ in range(num_trials):
+        start_time = time.time()
+        subprocess.check_call(baseline_command, cwd=ROOT_PATH)
+        baseline_time = time.time() - start_time
+        start_time = time.time()
+        subprocess.check_call(command, cwd=ROOT_PATH)
+        runtimes.append(time.time() - start_time - baseline_time)
+    return min(runtimes)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num_trials', type=int, default=10,
+                        help='The number of fresh interpreters per module')
+    parser.add_argument('-t', '--max_time', type=float, default=None,
+                        help='Fails if any import takes longer than this many seconds')
+    args = parser.parse_args()
+    print('Arguments:', args)
+
+    regressions = []
+    for module in MODULES:
+        runtime = time_import(module, num_trials=args.num_trials)
+        print('Module: {} | Import time: {:.3f}'.format(module, runtime))
+        if (args.max_time is not None) and (args.max_time < runtime):
+            regressions.append(module)
+    if regressions:
+        print('Slow imports:', regressions)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
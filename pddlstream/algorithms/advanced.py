@@ -5,13 +5,15 @@ from pddlstream.language.constants import get_prefix, get_args
 from pddlstream.language.conversion import substitute_expression
 from pddlstream.language.fluent import get_predicate_map
 from pddlstream.language.function import Function
-from pddlstream.language.optimizer import UNSATISFIABLE, ConstraintStream
+from pddlstream.language.optimizer import UNSATISFIABLE, ConstraintStream, ComponentStream
 from pddlstream.language.stream import Stream
+from pddlstream.language.temporal import SimplifiedDomain
 from pddlstream.utils import find_unique, get_mapping
 
 UNIVERSAL_TO_CONDITIONAL = False
 AUTOMATICALLY_NEGATE = True # TODO: fix Yang's bug
 # TODO: AUTOMATICALLY_NEGATE = False can omit collisions
+PRUNE_IRRELEVANT = True # Skips instantiating streams whose certified facts cannot support the goal
 
 
 def get_predicates(expression):
@@ -141,6 +143,60 @@ def get_certifiers(externals):
     return certifiers
 
 
+##################################################
+
+def get_cost_functions(action):
+    import pddl
+    if (action.cost is None) or not isinstance(action.cost.expression, pddl.PrimitiveNumericExpression):
+        return set()
+    return {action.cost.expression.symbol}
+
+
+def get_relevant_predicates(domain, goal_exp, externals):
+    # Backward relaxed relevance: which predicates could (transitively) support the goal
+    from pddlstream.algorithms.downward import parse_goal
+    relevant = {UNSATISFIABLE} | get_predicates(parse_goal(goal_exp, domain))
+    changed = True
+    while changed:
+        num_relevant = len(relevant)
+        for action in domain.actions:
+            if not any(effect.literal.predicate in relevant for effect in action.effects):
+                continue
+            relevant.update(get_predicates(action.precondition))
+            for effect in action.effects:
+                relevant.update(get_predicates(effect.condition))
+            relevant.update(get_cost_functions(action))
+        for axiom in domain.axioms:
+            if axiom.name in relevant:
+                relevant.update(get_predicates(axiom.condition))
+        for external in externals:
+            if isinstance(external, (Stream, Function)) and (get_certified_predicates(external) & relevant):
+                relevant.update(get_domain_predicates(external))
+        changed = (num_relevant != len(relevant))
+    return relevant
+
+
+def is_relevant_external(external, relevant_predicates):
+    if isinstance(external, ComponentStream) or not isinstance(external, (Stream, Function)):
+        return True # Optimizers are kept because disabled axioms can depend on their facts
+    return bool(get_certified_predicates(external) & relevant_predicates)
+
+
+def prune_irrelevant_externals(domain, goal_exp, externals, verbose=True):
+    # TODO: relevance at the level of objects (constants) in addition to predicates
+    if not PRUNE_IRRELEVANT or isinstance(domain, SimplifiedDomain):
+        return list(externals)
+    relevant_predicates = get_relevant_predicates(domain, goal_exp, externals)
+    relevant_externals = [external for external in externals
+                          if is_relevant_external(external, relevant_predicates)]
+    if verbose and (len(relevant_externals) != len(externals)):
+        print('Pruned {} irrelevant externals: {}'.format(
+            len(externals) - len(relevant_externals),
+            sorted(external.name for external in externals if external not in relevant_externals)))
+    return relevant_externals
+
+##################################################
+
 def get_negated_predicates(domain):
     # TODO: generalize to more complicated formulas and recursive axioms
     import pddl
@@ -2,7 +2,8 @@ from collections import Counter
 
 from pddlstream.algorithms.common import evaluations_from_init, SOLUTIONS
 from pddlstream.algorithms.constraints import add_plan_constraints
-from pddlstream.algorithms.downward import parse_lisp, parse_goal, has_costs, set_unit_costs, normalize_domain_goal
+from pddlstream.algorithms.downward import parse_lisp, parse_goal, has_costs, set_unit_costs, normalize_domain_goal, \
+    clear_fd_caches, load_translator
 from pddlstream.language.temporal import parse_domain, SimplifiedDomain
 from pddlstream.language.constants import get_prefix, get_args
 from pddlstream.language.conversion import obj_from_value_expression
@@ -69,6 +70,7 @@ def reset_globals():
     # TODO: maintain these dictionaries in an object
     Object.reset()
     OptimisticObject.reset()
+    clear_fd_caches()
     RULES[:] = []
     SOLUTIONS[:] = []
 
@@ -77,6 +79,7 @@ def parse_problem(problem, stream_info={}, constraints=None, unit_costs=False, u
     #reset_globals() # Prevents use of satisfaction.py
     domain_pddl, constant_map, stream_pddl, stream_map, init, goal = problem
 
+    load_translator() # Entry point of the algorithms, which import the translator's modules
     domain = parse_domain(domain_pddl) # TODO: normalize here
     #domain = domain_pddl
     if len(domain.types) != 1:
@@ -1,9 +1,13 @@
+import threading
 import time
 from collections import namedtuple, OrderedDict
+from copy import copy
 
 from pddlstream.language.constants import is_plan, get_length, FAILED #, INFEASIBLE, SUCCEEDED
 from pddlstream.language.conversion import evaluation_from_fact, obj_from_value_expression, revert_solution
-from pddlstream.utils import INF, elapsed_time, check_memory
+from pddlstream.algorithms.downward import release_temp_dir
+from pddlstream.utils import INF, elapsed_time, check_memory, install_thread_output, \
+    uninstall_thread_output, SOLVE_LOCK
 
 # Complexity is a way to characterize the number of external evaluations required for a solution
 # Most algorithms regularize to prefer lower complexity solutions
@@ -22,8 +26,74 @@ Solution = namedtuple('Solution', ['plan', 'cost', 'time'])
 
 SOLUTIONS = [] # TODO: remove global variable
 
+class Deadline(object):
+    # A single time budget that is shared by every search and sampling subroutine of a solve
+    def __init__(self, max_time=INF, search_fraction=None, start_time=None):
+        self.start_time = time.time() if start_time is None else start_time
+        self.max_time = max_time
+        self.search_fraction = search_fraction # None: search and sampling share the entire budget
+        assert (self.search_fraction is None) or (0 <= self.search_fraction <= 1)
+        self.sample_time = 0.
+    @property
+    def search_time(self):
+        return self.elapsed_time() - self.sample_time
+    def elapsed_time(self):
+        return elapsed_time(self.start_time)
+    def remaining_time(self):
+        return max(0., self.max_time - self.elapsed_time())
+    def is_expired(self):
+        return self.remaining_time() <= 0
+    def remaining_search_time(self):
+        if self.search_fraction is None:
+            return self.remaining_time()
+        return min(self.remaining_time(), max(0., self.search_fraction*self.max_time - self.search_time))
+    def remaining_sample_time(self):
+        if self.search_fraction is None:
+            return self.remaining_time()
+        return min(self.remaining_time(), max(0., (1 - self.search_fraction)*self.max_time - self.sample_time))
+    def get_planner_time(self, max_planner_time):
+        # Clamps the time of a single planner call to the remaining search budget
+        return min(max_planner_time, self.remaining_search_time())
+    def __repr__(self):
+        return '{}({:.3f}/{:.3f})'.format(self.__class__.__name__, self.elapsed_time(), self.max_time)
+
+class BackgroundSearch(object):
+    """
+    Runs a search in a background thread, which mostly waits on the planner subprocess
+    The search holds SOLVE_LOCK except while it waits on its planner,
+    so the main thread holds SOLVE_LOCK whenever it modifies the state that the search reads
+    """
+    def __init__(self, search_fn, evaluations, **kwargs):
+        assert not SOLVE_LOCK.owned()
+        self.evaluations = copy(evaluations) # Snapshot that sampling cannot modify
+        self.output = self.error = None
+        self.stdout = install_thread_output() # Verbose within the search only silences the search
+        self.started = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(search_fn,), kwargs=kwargs)
+        self.thread.daemon = True
+        self.thread.start()
+        self.started.wait() # The search acquires SOLVE_LOCK before sampling resumes
+    def run(self, search_fn, **kwargs):
+        with SOLVE_LOCK:
+            self.started.set()
+            try:
+                self.output = search_fn(self.evaluations, **kwargs)
+            except Exception as error:
+                self.error = error
+            finally:
+                release_temp_dir() # The thread is not reused
+    def join(self):
+        assert not SOLVE_LOCK.owned() # Otherwise, the search cannot finish
+        self.thread.join()
+        uninstall_thread_output(self.stdout) # Only for the lifetime of the search
+        if self.error is not None:
+            raise self.error
+        return self.output
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, len(self.evaluations))
+
 class SolutionStore(object):
-    def __init__(self, evaluations, max_time, success_cost, verbose, max_memory=INF):
+    def __init__(self, evaluations, max_time, success_cost, verbose, max_memory=INF, search_fraction=None):
         # TODO: store a map from head to value?
         # TODO: include other problem information here?
         # TODO: determine when the plan converges
@@ -31,15 +101,22 @@ class SolutionStore(object):
         #self.initial_evaluations = copy.copy(evaluations)
         self.start_time = time.time()
         self.max_time = max_time
+        self.deadline = Deadline(max_time, search_fraction=search_fraction, start_time=self.start_time)
         self.max_memory = max_memory
         self.success_cost = success_cost # Inclusive
         self.verbose = verbose
         #self.best_cost = self.cost_fn(self.best_plan)
         self.solutions = []
-        self.sample_time = 0.
+        self.process_usages = [] # Resource usage of each external planner call made during this solve
+    @property
+    def sample_time(self):
+        return self.deadline.sample_time
+    @sample_time.setter
+    def sample_time(self, sample_time):
+        self.deadline.sample_time = sample_time
     @property
     def search_time(self):
-        return self.elapsed_time() - self.sample_time
+        return self.deadline.search_time
     @property
     def best_plan(self):
         # TODO: return INFEASIBLE if can prove no solution
@@ -58,7 +135,7 @@ class SolutionStore(object):
     def elapsed_time(self):
         return elapsed_time(self.start_time)
     def is_timeout(self):
-        return (self.max_time <= self.elapsed_time()) or not check_memory(self.max_memory)
+        return self.deadline.is_expired() or not check_memory(self.max_memory)
     def is_terminated(self):
         return self.is_solved() or self.is_timeout()
     #def __repr__(self):
@@ -80,6 +157,10 @@ class SolutionStore(object):
             'sample_time': self.sample_time,
             'run_time': self.elapsed_time(),
             'timeout': self.is_timeout(),
+            'planner_calls': len(self.process_usages),
+            'planner_cpu_time': sum(usage.cpu_time for usage in self.process_usages),
+            'planner_peak_memory': max([0] + [usage.peak_memory for usage in self.process_usages]),
+            'planner_kills': sum(usage.killed for usage in self.process_usages),
             #'status': status,
         }
 
@@ -1,17 +1,27 @@
 from __future__ import print_function
 
+import atexit
 import os
 import re
 import sys
+import shlex
 import subprocess
-from collections import namedtuple, defaultdict
+import tempfile
+import threading
+from collections import namedtuple, defaultdict, Counter
 from time import time
+from weakref import WeakKeyDictionary
+
+try:
+    from StringIO import StringIO # Python 2 (accepts str)
+except ImportError:
+    from io import StringIO
 
 from pddlstream.language.constants import EQ, NOT, Head, Evaluation, get_prefix, get_args, OBJECT, TOTAL_COST, Action, Not
-from pddlstream.language.conversion import is_atom, is_negated_atom, objects_from_evaluations, pddl_from_object, \
+from pddlstream.language.conversion import is_atom, is_negated_atom, pddl_from_object, \
     pddl_list_from_expression, obj_from_pddl
 from pddlstream.utils import read, write, INF, clear_dir, get_file_path, MockSet, find_unique, int_ceil, \
-    safe_remove, safe_zip, elapsed_time
+    safe_remove, safe_zip, elapsed_time, flatten, mkdir, safe_rm_dir, ExternalProcess, sleep_unlocked
 from pddlstream.language.write_pddl import get_problem_pddl
 
 USE_CERBERUS = False
@@ -27,6 +37,8 @@ FORBID_COMMAND = os.path.join(FORBID_PATH, FORBID_TEMPLATE)
 assert not USE_CERBERUS or not USE_FORBID
 # Does not support derived predicates
 
+DEBUG_PDDL = False # Writes the domain and problem PDDL files for every search
+
 ##################################################
 
 filepath = os.path.abspath(__file__)
@@ -41,34 +53,75 @@ def find_build(fd_path):
     # TODO: could also just automatically compile
     raise RuntimeError('Please compile FastDownward first [.../pddlstream$ ./downward/build.py]')
 
-# TODO: check at runtime so users can use utils without FD
 FD_PATH = get_file_path(__file__, '../../downward/')
 #FD_PATH = get_file_path(__file__, '../../FastDownward/')
-TRANSLATE_PATH = os.path.join(find_build(FD_PATH), 'bin/translate')
-FD_BIN = os.path.join(find_build(CERBERUS_PATH if USE_CERBERUS else FD_PATH), 'bin')
 
 DOMAIN_INPUT = 'domain.pddl'
 PROBLEM_INPUT = 'problem.pddl'
 TRANSLATE_FLAGS = [] #if USE_CERBERUS else ['--negative-axioms']
-original_argv = sys.argv[:]
-sys.argv = sys.argv[:1] + TRANSLATE_FLAGS + [DOMAIN_INPUT, PROBLEM_INPUT]
-sys.path.append(TRANSLATE_PATH)
 # TODO: max translate time
 
-import pddl.f_expression
-import pddl
-import instantiate
-import pddl_parser.lisp_parser
-import normalize
-import pddl_parser
-from pddl_parser.parsing_functions import parse_domain_pddl, parse_task_pddl, \
-    parse_condition, check_for_duplicates
-sys.argv = original_argv
-
-TEMP_DIR = 'temp/'
+# The build lookup and the translator imports are deferred until FastDownward is first used
+BUILD_FROM_PATH = {}
+TRANSLATOR_LOADED = [] # Non-empty after the translator was added to sys.path
+
+def get_build(fd_path):
+    if fd_path not in BUILD_FROM_PATH:
+        BUILD_FROM_PATH[fd_path] = find_build(fd_path)
+    return BUILD_FROM_PATH[fd_path]
+
+def get_translate_path():
+    return os.path.join(get_build(FD_PATH), 'bin/translate')
+
+def get_fd_bin():
+    return os.path.join(get_build(CERBERUS_PATH if USE_CERBERUS else FD_PATH), 'bin')
+
+def load_translator():
+    if TRANSLATOR_LOADED:
+        return False
+    translate_path = get_translate_path() # Raises before marking the translator as loaded
+    TRANSLATOR_LOADED.append(translate_path)
+    sys.path.append(translate_path)
+    # The translator's options module parses sys.argv upon its import
+    original_argv = sys.argv[:]
+    sys.argv = sys.argv[:1] + TRANSLATE_FLAGS + [DOMAIN_INPUT, PROBLEM_INPUT]
+    try:
+        import options
+    finally:
+        sys.argv = original_argv
+    import pddl.f_expression
+    pddl.f_expression.COST_SCALE = get_cost_scale()
+    return True
+
+class LazyModule(object):
+    # Module proxy that imports the module upon its first attribute access
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+    def __getattr__(self, attribute):
+        if self._module is None:
+            import importlib
+            load_translator() # Reports a missing build
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self._name)
+
+pddl = LazyModule('pddl')
+instantiate = LazyModule('instantiate')
+normalize = LazyModule('normalize')
+lisp_parser = LazyModule('pddl_parser.lisp_parser')
+parsing_functions = LazyModule('pddl_parser.parsing_functions')
+
+SHARED_MEMORY_DIR = '/dev/shm' # Avoids touching the disk when available
+TEMP_ROOT = SHARED_MEMORY_DIR if os.path.isdir(SHARED_MEMORY_DIR) else tempfile.gettempdir()
+TEMP_PREFIX = 'pddlstream-'
+TEMP_DIR = None # None uses a unique directory per process and thread within TEMP_ROOT
 TRANSLATE_OUTPUT = 'output.sas'
 SEARCH_OUTPUT = 'sas_plan'
-SEARCH_COMMAND = 'downward --internal-plan-file {} {} < {}'
+SEARCH_LOG = 'search.log'
+COST_REGEX = r'cost\s*=\s*(\d+)'
+SEARCH_COMMAND = 'downward --internal-plan-file {} {}'
 INFINITY = 'infinity'
 GOAL_NAME = '@goal' # @goal-reachable
 
@@ -183,6 +236,14 @@ DEFAULT_MAX_TIME = 30 # INF
 DEFAULT_CONSERVATIVE_PLANNER = 'ff-astar'
 DEFAULT_GREEDY_PLANNER = 'ff-astar2'
 DEFAULT_PLANNER = DEFAULT_GREEDY_PLANNER
+MAX_PLANNER_MEMORY = INF # KB of address space for each planner process
+
+PORTFOLIO = 'portfolio' # Concurrently runs PORTFOLIO_PLANNERS (or pass a list of planners)
+PORTFOLIO_PLANNERS = ['ff-eager', 'ff-lazy', 'lmcut-astar']
+PORTFOLIO_SIZE = INF # Maximum number of planners launched at once (prior winners first)
+PORTFOLIO_PERIOD = 1e-2 # Seconds between polls
+SEARCH_PERIOD = 1e-2 # Seconds between checks for new anytime plans
+PORTFOLIO_WINS = Counter() # Number of portfolio searches each planner has won
 
 def print_search_options():
     for i, (name, command) in enumerate(sorted(SEARCH_OPTIONS.items())):
@@ -197,11 +258,15 @@ def round_cost(cost):
     cost_scale = get_cost_scale()
     return int(cost_scale * cost) / cost_scale
 
+COST_SCALE = [1] # Mirrors pddl.f_expression.COST_SCALE without loading the translator
+
 def get_cost_scale():
-    return pddl.f_expression.COST_SCALE
+    return COST_SCALE[0]
 
 def set_cost_scale(cost_scale):
-    pddl.f_expression.COST_SCALE = cost_scale
+    COST_SCALE[0] = cost_scale
+    if TRANSLATOR_LOADED:
+        pddl.f_expression.COST_SCALE = cost_scale
 
 def convert_value(value):
     if value == INF:
@@ -221,7 +286,8 @@ set_cost_scale(cost_scale=1e3) # TODO: make unit costs be equivalent to cost sca
 ##################################################
 
 def parse_lisp(lisp):
-    return pddl_parser.lisp_parser.parse_nested_list(lisp.splitlines())
+    load_translator() # Parsing is the entry point of the translator's modules
+    return lisp_parser.parse_nested_list(lisp.splitlines())
 
 # TODO: dynamically generate type_dict and predicate_dict
 Domain = namedtuple('Domain', ['name', 'requirements', 'types', 'type_dict', 'constants',
@@ -230,7 +296,7 @@ Domain = namedtuple('Domain', ['name', 'requirements', 'types', 'type_dict', 'co
 def parse_sequential_domain(domain_pddl):
     if isinstance(domain_pddl, Domain):
         return domain_pddl
-    args = list(parse_domain_pddl(parse_lisp(domain_pddl))) + [domain_pddl]
+    args = list(parsing_functions.parse_domain_pddl(parse_lisp(domain_pddl))) + [domain_pddl]
     domain = Domain(*args)
     # for action in domain.actions:
     #    if (action.cost is not None) and isinstance(action.cost, pddl.Increase) and isinstance(action.cost.expression, pddl.NumericConstant):
@@ -243,7 +309,7 @@ Problem = namedtuple('Problem', ['task_name', 'task_domain_name', 'task_requirem
 def parse_problem(domain, problem_pddl):
     if isinstance(problem_pddl, Problem):
         return problem_pddl
-    args = list(parse_task_pddl(parse_lisp(problem_pddl), domain.type_dict, domain.predicate_dict)) + [problem_pddl]
+    args = list(parsing_functions.parse_task_pddl(parse_lisp(problem_pddl), domain.type_dict, domain.predicate_dict)) + [problem_pddl]
     return Problem(*args)
 
 #def parse_action(lisp_list):
@@ -302,6 +368,34 @@ def fd_from_evaluation(evaluation):
 def fd_from_evaluations(evaluations):
     return [fd_from_evaluation(e) for e in evaluations if not is_negated_atom(e)]
 
+# Append-only conversion caches reused across planner calls (cleared by reset_globals)
+# FD facts and objects are never mutated after their conversion (tasks only copy and extend init)
+# Like the other translation caches, only accessed while holding SOLVE_LOCK during a background search
+FD_FROM_EVALUATION = {} # Evaluation -> Atom, NegatedAtom, or Assign
+FD_OBJECTS_FROM_EVALUATION = {} # Evaluation -> list of TypedObject
+
+def clear_fd_caches():
+    FD_FROM_EVALUATION.clear()
+    FD_OBJECTS_FROM_EVALUATION.clear()
+
+def convert_evaluation(evaluation):
+    if evaluation not in FD_FROM_EVALUATION:
+        FD_FROM_EVALUATION[evaluation] = fd_from_evaluation(evaluation)
+        FD_OBJECTS_FROM_EVALUATION[evaluation] = [make_object(pddl_from_object(obj))
+                                                  for obj in evaluation.head.args]
+    return FD_FROM_EVALUATION[evaluation]
+
+def convert_evaluations(evaluations):
+    # Only converts the evaluations that were not previously converted
+    init = []
+    typed_objects = set()
+    for evaluation in evaluations:
+        fd_evaluation = convert_evaluation(evaluation)
+        typed_objects.update(FD_OBJECTS_FROM_EVALUATION[evaluation])
+        if not is_negated_atom(evaluation):
+            init.append(fd_evaluation)
+    return init, typed_objects
+
 ##################################################
 
 def parse_goal(goal_exp, domain):
@@ -309,20 +403,20 @@ def parse_goal(goal_exp, domain):
     #    pass
     #except SystemExit as e:
     #    return False
-    return parse_condition(pddl_list_from_expression(goal_exp),
+    return parsing_functions.parse_condition(pddl_list_from_expression(goal_exp),
                            domain.type_dict, domain.predicate_dict).simplified()
 
 def get_problem(evaluations, goal_exp, domain, unit_costs=False):
-    objects = objects_from_evaluations(evaluations)
-    typed_objects = list({make_object(pddl_from_object(obj)) for obj in objects} - set(domain.constants))
+    init, typed_objects = convert_evaluations(evaluations)
+    typed_objects = list(typed_objects - set(domain.constants))
     # TODO: this doesn't include =
-    init = fd_from_evaluations(evaluations)
     goal = pddl.Truth() if goal_exp is None else parse_goal(goal_exp, domain)
     #print('{} objects and {} atoms'.format(len(objects), len(init)))
     problem_pddl = None
     if USE_FORBID:
         problem_pddl = get_problem_pddl(evaluations, goal_exp, domain.pddl, temporal=False)
-    write_pddl(domain.pddl, problem_pddl, temp_dir=TEMP_DIR)
+    if USE_FORBID or DEBUG_PDDL:
+        write_pddl(domain.pddl, problem_pddl)
     return Problem(task_name=domain.name, task_domain_name=domain.name,
                    objects=sorted(typed_objects, key=lambda o: o.name),
                    task_requirements=pddl.tasks.Requirements([]), init=init, goal=goal,
@@ -339,8 +433,75 @@ def get_identical_atoms(objects):
             assert obj.is_shared()
     return init
 
-def task_from_domain_problem(domain, problem, add_identical=True):
-    # TODO: prune evaluation that aren't needed in actions
+def get_condition_predicates(condition):
+    if isinstance(condition, pddl.Literal):
+        return {condition.predicate}
+    if isinstance(condition, (pddl.conditions.JunctorCondition, pddl.conditions.QuantifiedCondition)):
+        return set(flatten(map(get_condition_predicates, condition.parts)))
+    return set()
+
+def is_quantified(condition):
+    if isinstance(condition, pddl.conditions.QuantifiedCondition):
+        return True
+    if isinstance(condition, pddl.conditions.JunctorCondition):
+        return any(map(is_quantified, condition.parts))
+    return False
+
+def is_bound(parameters, condition):
+    # All parameters must be constrained by an atom for objects to be safely pruned
+    bound = {arg for part in get_conjunctive_parts(condition)
+             if isinstance(part, pddl.Atom) for arg in part.args}
+    return all(p.name in bound for p in parameters)
+
+OperatorSummary = namedtuple('OperatorSummary', ['condition', 'predicates', 'prunable'])
+SUMMARY_FROM_OPERATOR = WeakKeyDictionary() # Stream domains share the original operators
+
+def summarize_operator(operator):
+    # Cached per operator and recomputed if its condition was replaced
+    condition = get_precondition(operator)
+    summary = SUMMARY_FROM_OPERATOR.get(operator)
+    if (summary is not None) and (summary.condition is condition):
+        return summary
+    predicates = get_condition_predicates(condition)
+    prunable = not is_quantified(condition) and is_bound(operator.parameters, condition)
+    if isinstance(operator, pddl.Action):
+        for effect in operator.effects:
+            predicates.update(get_condition_predicates(effect.condition))
+            prunable &= not effect.parameters and not is_quantified(effect.condition)
+        if (operator.cost is not None) and isinstance(operator.cost.expression, pddl.PrimitiveNumericExpression):
+            predicates.add(operator.cost.expression.symbol)
+    summary = OperatorSummary(condition, predicates, prunable)
+    SUMMARY_FROM_OPERATOR[operator] = summary
+    return summary
+
+def get_fact_symbol(fact):
+    if isinstance(fact, pddl.f_expression.FunctionAssignment):
+        return fact.fluent.symbol
+    return fact.predicate
+
+def prune_problem(domain, objects, init, goal, verbose=False):
+    """
+    Removes initial facts whose predicates are never read by an action, axiom, cost or goal
+    as well as (non-constant) objects that no remaining fact mentions
+    """
+    summaries = list(map(summarize_operator, domain.actions + domain.axioms))
+    read_predicates = set(get_condition_predicates(goal))
+    for summary in summaries:
+        read_predicates.update(summary.predicates)
+    relevant_init = [fact for fact in init if get_fact_symbol(fact) in read_predicates]
+    relevant_objects = objects
+    if all(summary.prunable for summary in summaries) and not is_quantified(goal):
+        mentioned = {obj.name for obj in domain.constants}
+        for fact in relevant_init:
+            args = fact.fluent.args if isinstance(fact, pddl.f_expression.FunctionAssignment) else fact.args
+            mentioned.update(args)
+        relevant_objects = [obj for obj in objects if obj.name in mentioned]
+    if verbose:
+        print('Pruned {}/{} facts and {}/{} objects'.format(
+            len(init) - len(relevant_init), len(init), len(objects) - len(relevant_objects), len(objects)))
+    return relevant_objects, relevant_init, read_predicates
+
+def task_from_domain_problem(domain, problem, add_identical=True, prune=False, verbose=False):
     #domain_name, domain_requirements, types, type_dict, constants, \
     #    predicates, predicate_dict, functions, actions, axioms = domain
     task_name, task_domain_name, task_requirements, objects, init, goal, use_metric, problem_pddl = problem
@@ -348,12 +509,17 @@ def task_from_domain_problem(domain, problem, add_identical=True):
     assert domain.name == task_domain_name
     requirements = pddl.Requirements(sorted(set(domain.requirements.requirements +
                                                 task_requirements.requirements)))
+    read_predicates = None
+    if prune:
+        # Only safe when the task is solely used for grounding (e.g. fluent negated streams read real states)
+        objects, init, read_predicates = prune_problem(domain, objects, init, goal, verbose=verbose)
     objects = domain.constants + objects
-    check_for_duplicates([o.name for o in objects],
+    parsing_functions.check_for_duplicates([o.name for o in objects],
         errmsg="error: duplicate object %r",
         finalmsg="please check :constants and :objects definitions")
-    init.extend(pddl.Atom(EQ, (obj.name, obj.name)) for obj in objects)
-    if add_identical:
+    if (read_predicates is None) or (EQ in read_predicates):
+        init.extend(pddl.Atom(EQ, (obj.name, obj.name)) for obj in objects)
+    if add_identical and ((read_predicates is None) or (IDENTICAL in read_predicates)):
         init.extend(get_identical_atoms(objects))
     #print('{} objects and {} atoms'.format(len(objects), len(init)))
 
@@ -410,34 +576,96 @@ def normalize_domain_goal(domain, goal_exp):
     normalize.normalize(task)
     return task
 
+def get_sas_string(sas_task):
+    stream = StringIO()
+    sas_task.output(stream)
+    return stream.getvalue()
+
+def get_search_command(temp_dir, planner=DEFAULT_PLANNER, max_planner_time=DEFAULT_MAX_TIME, max_cost=INF):
+    max_time = convert_value(max_planner_time)
+    max_cost = convert_value(scale_cost(max_cost))
+    search = os.path.abspath(os.path.join(get_fd_bin(), SEARCH_COMMAND))
+    if planner == 'cerberus':
+        planner_config = SEARCH_OPTIONS[planner] # Check if max_time, max_cost exist
+    else:
+        planner_config = SEARCH_OPTIONS[planner] % (max_time, max_cost)
+    return search.format(os.path.join(temp_dir, SEARCH_OUTPUT), planner_config)
+
+def is_portfolio(planner):
+    return (planner == PORTFOLIO) or isinstance(planner, (list, tuple))
+
+def write_input(proc, sas_input):
+    if sas_input is None:
+        return
+    try:
+        proc.stdin.write(sas_input)
+        proc.stdin.close()
+    except (IOError, OSError): # The search already terminated
+        pass
+
+def is_complete_solution(solution):
+    # The cost comment is the final line that FastDownward writes
+    return (solution is not None) and solution.endswith('\n') and bool(re.search(COST_REGEX, solution))
+
+def read_new_plans(temp_path, parsed_files, running=False):
+    # Parses each plan that the search finished writing since the last call
+    plans = []
+    plan_files = sorted(f for f in os.listdir(temp_path)
+                        if f.startswith(SEARCH_OUTPUT) and (f not in parsed_files))
+    for plan_file in plan_files:
+        solution = read(os.path.join(temp_path, plan_file))
+        if not running or is_complete_solution(solution):
+            parsed_files.add(plan_file)
+            plans.append(parse_solution(solution))
+    return plans
+
+def watch_plans(temp_path, proc, period=SEARCH_PERIOD):
+    # Yields each plan as soon as the (anytime) search finishes writing it
+    parsed_files = set()
+    while True:
+        running = proc.poll() is None
+        for plan in read_new_plans(temp_path, parsed_files, running=running):
+            yield plan
+        if not running:
+            break
+        sleep_unlocked(period) # Lets the main thread sample during a background search
+
 def run_search(temp_dir, planner=DEFAULT_PLANNER, max_planner_time=DEFAULT_MAX_TIME,
-               max_cost=INF, debug=False):
+               max_cost=INF, debug=False, sas_task=None, plan_fn=None, terminate_cost=-INF, process_usages=None):
     """
     Runs FastDownward's search phase on translated SAS+ problem TRANSLATE_OUTPUT
-    :param temp_dir: the directory for temporary FastDownward input and output files
+    :param temp_dir: the directory for temporary FastDownward input and output files (None for a unique one)
     :param planner: a keyword for the FastDownward search configuration in SEARCH_OPTIONS
+        (or PORTFOLIO or a list of keywords to run several configurations concurrently)
     :param max_planner_time: the maximum runtime of FastDownward
     :param max_cost: the maximum FastDownward plan cost
     :param debug: If True, print the FastDownward search output
+    :param sas_task: If not None, the SAS+ task that is streamed to FastDownward instead of TRANSLATE_OUTPUT
+    :param plan_fn: If not None, called on (plan, cost) for each improved plan while the search is still running
+    :param terminate_cost: the exclusive (strict) upper bound on plan cost to terminate the search early
+    :param process_usages: If not None, a list that is extended with the ProcessUsage of each search process
     :return: a tuple (plan, cost) where plan is a sequence of PDDL actions
         (or None) and cost is the cost of the plan (INF if no plan)
     """
-    max_time = convert_value(max_planner_time)
-    max_cost = convert_value(scale_cost(max_cost))
+    if is_portfolio(planner) and not USE_FORBID:
+        planners = PORTFOLIO_PLANNERS if (planner == PORTFOLIO) else planner
+        return run_portfolio(temp_dir, planners, max_planner_time=max_planner_time, max_cost=max_cost,
+                             debug=debug, sas_task=sas_task, plan_fn=plan_fn, terminate_cost=terminate_cost,
+                             process_usages=process_usages)
     start_time = time()
-    search = os.path.abspath(os.path.join(FD_BIN, SEARCH_COMMAND))
-    if planner == 'cerberus':
-        planner_config = SEARCH_OPTIONS[planner] # Check if max_time, max_cost exist
-    else:
-        planner_config = SEARCH_OPTIONS[planner] % (max_time, max_cost)
-    temp_dir = os.path.abspath(temp_dir)
-    command = search.format(os.path.join(temp_dir, SEARCH_OUTPUT), planner_config,
-                            os.path.join(temp_dir, TRANSLATE_OUTPUT))
+    temp_dir = os.path.abspath(get_temp_dir(temp_dir))
+    command = get_search_command(temp_dir, planner, max_planner_time, max_cost)
+    sas_input = input_path = None
+    if sas_task is None:
+        input_path = os.path.join(temp_dir, TRANSLATE_OUTPUT)
+    else: # Streamed through stdin
+        sas_input = get_sas_string(sas_task).encode(encoding='UTF-8')
 
     domain_path = os.path.abspath(os.path.join(temp_dir, DOMAIN_INPUT))
     problem_path = os.path.abspath(os.path.join(temp_dir, PROBLEM_INPUT))
     if USE_FORBID:
         command = FORBID_COMMAND.format(num=2, domain=domain_path, problem=problem_path)
+        sas_input = input_path = None
     if debug:
         print('Search command:', command)
 
@@ -451,14 +679,29 @@ def run_search(temp_dir, planner=DEFAULT_PLANNER, max_planner_time=DEFAULT_MAX_T
     #except subprocess.CalledProcessError as e:
     #    print(e)
 
-    #temp_path = temp_dir
-    temp_path = os.path.join(os.getcwd(), TEMP_DIR) # TODO: temp dir?
+    temp_path = temp_dir
     for filename in os.listdir(temp_path):
         if filename.startswith(SEARCH_OUTPUT):
             safe_remove(os.path.join(temp_path, filename))
 
-    proc = subprocess.Popen(command, stdout=subprocess.PIPE, shell=True, cwd=None, close_fds=True)
-    output, error = proc.communicate()
+    log_path = os.path.join(temp_path, SEARCH_LOG)
+    # Executed without a shell so that the limits and usage apply to the search itself
+    with open(log_path, 'w') as stdout, open(input_path or os.devnull, 'r') as input_file:
+        stdin = input_file if sas_input is None else subprocess.PIPE
+        proc = ExternalProcess(shlex.split(command), name=planner, max_time=max_planner_time,
+                               max_memory=MAX_PLANNER_MEMORY, usages=process_usages,
+                               stdin=stdin, stdout=stdout, cwd=None, close_fds=True)
+    write_input(proc, sas_input)
+    best_cost = INF
+    for plan, cost in watch_plans(temp_path, proc):
+        if cost < best_cost:
+            best_cost = cost
+            if plan_fn is not None:
+                plan_fn(plan, cost)
+            if cost < terminate_cost:
+                break
+    proc.kill()
+    output = read(log_path)
     #if proc.returncode not in [0, 12]: # Good: [0, 12] | Bad: [127]
     #    raise RuntimeError(proc.returncode)
 
@@ -468,12 +711,80 @@ def run_search(temp_dir, planner=DEFAULT_PLANNER, max_planner_time=DEFAULT_MAX_T
                 os.rename(os.path.join(FORBID_PATH, filename), os.path.join(temp_path, filename))
 
     if debug:
-        print(output.decode(encoding='UTF-8')[:-1])
+        print(output[:-1])
         print('Search runtime: {:.3f}'.format(elapsed_time(start_time)))
     plan_files = sorted(f for f in os.listdir(temp_path) if f.startswith(SEARCH_OUTPUT))
     print('Plans:', plan_files)
     return parse_solutions(temp_path, plan_files)
 
+def get_portfolio(planners=PORTFOLIO_PLANNERS):
+    # Biases toward the planners that have won previous searches
+    ordered_planners = sorted(planners, key=lambda p: PORTFOLIO_WINS[p], reverse=True) # Stable
+    return ordered_planners[:min(len(ordered_planners), PORTFOLIO_SIZE)]
+
+def run_portfolio(temp_dir, planners=PORTFOLIO_PLANNERS, max_planner_time=DEFAULT_MAX_TIME,
+                  max_cost=INF, debug=False, sas_task=None, plan_fn=None, terminate_cost=-INF, process_usages=None):
+    """
+    Concurrently runs several FastDownward search configurations on the same SAS+ task
+    :param plan_fn: If not None, called on (plan, cost) for each improved plan of any planner
+        and the planners then run until a plan's cost is strictly below terminate_cost
+    :return: the first plan found by any planner (the best plan when plan_fn is not None)
+        or otherwise the best plan written by max_planner_time
+    """
+    start_time = time()
+    temp_dir = os.path.abspath(get_temp_dir(temp_dir))
+    if sas_task is None:
+        sas_input = read(os.path.join(temp_dir, TRANSLATE_OUTPUT))
+    else:
+        sas_input = get_sas_string(sas_task)
+    sas_input = sas_input.encode(encoding='UTF-8')
+
+    processes = {}
+    directories = {}
+    for planner in get_portfolio(planners):
+        directories[planner] = os.path.join(temp_dir, planner, '')
+        clear_dir(directories[planner])
+        command = get_search_command(directories[planner], planner, max_planner_time, max_cost)
+        if debug:
+            print('Search command:', command)
+        with open(os.path.join(directories[planner], SEARCH_LOG), 'w') as stdout:
+            processes[planner] = ExternalProcess(
+                shlex.split(command), name=planner, max_time=max_planner_time, max_memory=MAX_PLANNER_MEMORY,
+                usages=process_usages, stdin=subprocess.PIPE, stdout=stdout, stderr=subprocess.STDOUT, close_fds=True)
+        write_input(processes[planner], sas_input)
+
+    parsed_files = {planner: set() for planner in directories}
+    solutions = [] # (planner, plan, cost) for each improved plan
+    def update(planner, running=False):
+        for plan, cost in read_new_plans(directories[planner], parsed_files[planner], running=running):
+            if not solutions or (cost < solutions[-1][2]):
+                solutions.append((planner, plan, cost))
+                if plan_fn is not None:
+                    plan_fn(plan, cost)
+
+    while processes and (elapsed_time(start_time) < max_planner_time):
+        for planner in list(processes):
+            running = processes[planner].poll() is None
+            update(planner, running=running)
+            if not running:
+                del processes[planner]
+        if solutions and ((plan_fn is None) or (solutions[-1][2] < terminate_cost)):
+            break
+        sleep_unlocked(PORTFOLIO_PERIOD)
+    for planner, proc in processes.items():
+        proc.kill()
+        if not solutions or (plan_fn is not None): # Anytime planners might have written plans before the deadline
+            update(planner)
+    winner, best_plan, best_cost = solutions[-1] if solutions else (None, None, INF)
+
+    if winner is not None:
+        PORTFOLIO_WINS[winner] += 1
+        if debug:
+            print(read(os.path.join(directories[winner], SEARCH_LOG)))
+    print('Portfolio: {} | Winner: {} | Cost: {:.3f} | Runtime: {:.3f}'.format(
+        list(directories), winner, best_cost, elapsed_time(start_time)))
+    return best_plan, best_cost
+
 ##################################################
 
 def parse_action(line):
@@ -487,8 +798,7 @@ def parse_solution(solution):
     cost = INF
     if solution is None:
         return None, cost
-    cost_regex = r'cost\s*=\s*(\d+)'
-    matches = re.findall(cost_regex, solution)
+    matches = re.findall(COST_REGEX, solution)
     if matches:
         cost = float(matches[0]) / get_cost_scale()
     # TODO: recover the actual cost of the plan from the evaluations
@@ -507,6 +817,7 @@ def parse_solutions(temp_path, plan_files):
     return best_plan, best_cost
 
 def write_pddl(domain_pddl=None, problem_pddl=None, temp_dir=TEMP_DIR):
+    temp_dir = get_temp_dir(temp_dir)
     clear_dir(temp_dir)
     domain_path = os.path.join(temp_dir, DOMAIN_INPUT)
     if domain_pddl is not None:
@@ -518,6 +829,47 @@ def write_pddl(domain_pddl=None, problem_pddl=None, temp_dir=TEMP_DIR):
 
 ##################################################
 
+def remove_temp_dir(path, pid):
+    if os.getpid() == pid: # Forked children do not remove their parent's directory
+        safe_rm_dir(path)
+
+class ThreadTempDir(object):
+    # Removed by release_temp_dir once its thread's search returns or otherwise at exit
+    def __init__(self):
+        self.pid = os.getpid()
+        self.path = os.path.join(tempfile.mkdtemp(prefix=TEMP_PREFIX, dir=TEMP_ROOT), '') # Trailing slash for ensure_dir
+        THREAD_DIRS.add(self)
+    def remove(self):
+        THREAD_DIRS.discard(self)
+        remove_temp_dir(self.path, self.pid)
+
+THREAD_STORAGE = threading.local()
+THREAD_DIRS = set() # Directories that have not been released
+
+def release_temp_dir():
+    # Removes the temporary directory of the current thread (e.g. once a background search returns)
+    thread_dir = getattr(THREAD_STORAGE, 'temp_dir', None)
+    THREAD_STORAGE.temp_dir = None
+    if thread_dir is not None:
+        thread_dir.remove()
+
+@atexit.register
+def release_temp_dirs():
+    for thread_dir in list(THREAD_DIRS):
+        thread_dir.remove()
+
+def get_temp_dir(temp_dir=TEMP_DIR):
+    # Concurrent solves (processes or threads) would otherwise clobber each other's files
+    if temp_dir is not None:
+        return temp_dir
+    thread_dir = getattr(THREAD_STORAGE, 'temp_dir', None)
+    if (thread_dir is None) or (thread_dir.pid != os.getpid()): # Forked children receive a new directory
+        thread_dir = THREAD_STORAGE.temp_dir = ThreadTempDir()
+    mkdir(thread_dir.path) # In case it was cleaned
+    return thread_dir.path
+
+##################################################
+
 def literal_holds(state, literal):
     #return (literal in state) != literal.negated
     return (literal.positive() in state) != literal.negated
@@ -743,7 +1095,7 @@ def make_axiom(parameters, preconditions, derived):
 
 def make_domain(constants=[], predicates=[], functions=[], actions=[], axioms=[]):
     types = [pddl.Type(OBJECT)]
-    pddl_parser.parsing_functions.set_supertypes(types)
+    parsing_functions.set_supertypes(types)
     return Domain(name='', requirements=pddl.Requirements([]),
              types=types, type_dict={ty.name: ty for ty in types}, constants=constants,
              predicates=predicates, predicate_dict={p.name: p for p in predicates},
@@ -3,21 +3,23 @@ from __future__ import print_function
 import time
 
 from pddlstream.algorithms.algorithm import parse_problem
-from pddlstream.algorithms.advanced import enforce_simultaneous, automatically_negate_externals
-from pddlstream.algorithms.common import SolutionStore
+from pddlstream.algorithms.advanced import enforce_simultaneous, automatically_negate_externals, \
+    prune_irrelevant_externals
+from pddlstream.algorithms.common import SolutionStore, BackgroundSearch
 from pddlstream.algorithms.constraints import PlanConstraints
 from pddlstream.algorithms.disabled import push_disabled, reenable_disabled, process_stream_plan
-from pddlstream.algorithms.disable_skeleton import create_disabled_axioms
+from pddlstream.algorithms.disable_skeleton import create_disabled_axioms, extract_disabled_clusters
 #from pddlstream.algorithms.downward import has_costs
 from pddlstream.algorithms.incremental import process_stream_queue
 from pddlstream.algorithms.instantiation import Instantiator
-from pddlstream.algorithms.refinement import iterative_plan_streams, get_optimistic_solve_fn
+from pddlstream.algorithms.refinement import iterative_plan_streams, get_optimistic_solve_fn, get_search_fingerprint
 from pddlstream.algorithms.scheduling.plan_streams import OptSolution
+from pddlstream.algorithms.scheduling.recover_streams import get_result_key
 from pddlstream.algorithms.reorder import reorder_stream_plan
-from pddlstream.algorithms.skeleton import SkeletonQueue
+from pddlstream.algorithms.skeleton import SkeletonQueue, PRUNE_DOMINATED
 from pddlstream.algorithms.visualization import reset_visualizations, create_visualizations, \
     has_pygraphviz, log_plans
-from pddlstream.language.constants import is_plan, get_length, str_from_plan, INFEASIBLE
+from pddlstream.language.constants import is_plan, get_length, str_from_plan, INFEASIBLE, FAILED
 from pddlstream.language.fluent import compile_fluent_streams
 from pddlstream.language.function import Function, Predicate
 from pddlstream.language.optimizer import ComponentStream
@@ -25,7 +27,9 @@ from pddlstream.algorithms.recover_optimizers import combine_optimizers
 from pddlstream.language.statistics import load_stream_statistics, \
     write_stream_statistics, compute_plan_effort
 from pddlstream.language.stream import Stream, StreamResult
-from pddlstream.utils import INF, implies, str_from_object, safe_zip
+from pddlstream.utils import INF, implies, str_from_object, safe_zip, SOLVE_LOCK, Unlocked
+
+REUSE_SEARCHES = True # Returns the previous optimistic search when its inputs are unchanged
 
 def get_negative_externals(externals):
     negative_predicates = list(filter(lambda s: type(s) is Predicate, externals)) # and s.is_negative()
@@ -57,24 +61,21 @@ def recover_optimistic_outputs(stream_plan):
             new_mapping.update(safe_zip(new_result.output_objects, opt_result.output_objects))
     return new_stream_plan
 
-def check_dominated(skeleton_queue, stream_plan):
+def check_dominated(skeleton_queue, stream_plan, cost=INF):
+    # TODO: account for different output object values
     if not is_plan(stream_plan):
         return True
-    for skeleton in skeleton_queue.skeletons:
-        # TODO: has stream_plans and account for different output object values
-        if frozenset(stream_plan) <= frozenset(skeleton.stream_plan):
-            print(stream_plan)
-            print(skeleton.stream_plan)
-    raise NotImplementedError()
+    result_keys = frozenset(map(get_result_key, stream_plan))
+    return any(skeleton.dominates(result_keys, cost) for skeleton in skeleton_queue.skeletons)
 
 ##################################################
 
 def solve_abstract(problem, constraints=PlanConstraints(), stream_info={}, replan_actions=set(),
                   unit_costs=False, success_cost=INF,
-                  max_time=INF, max_iterations=INF, max_memory=INF,
+                  max_time=INF, max_iterations=INF, max_memory=INF, search_fraction=None,
                   initial_complexity=0, complexity_step=1, max_complexity=INF,
-                  max_skeletons=INF, search_sample_ratio=0, bind=True, max_failures=0,
-                  unit_efforts=False, max_effort=INF, effort_weight=None, reorder=True,
+                  max_skeletons=INF, search_sample_ratio=0, num_plans=1, bind=True, max_failures=0,
+                  unit_efforts=False, max_effort=INF, effort_weight=None, reorder=True, pipeline=False,
                   visualize=False, verbose=True, **search_kwargs):
     """
     Solves a PDDLStream problem by first planning with optimistic stream outputs and then querying streams
@@ -89,6 +90,7 @@ def solve_abstract(problem, constraints=PlanConstraints(), stream_info={}, repla
     :param max_time: the maximum runtime
     :param max_iterations: the maximum number of search iterations
     :param max_memory: the maximum amount of memory
+    :param search_fraction: if not None, the fraction of max_time reserved for search (the rest is for sampling)
 
     :param initial_complexity: the initial stream complexity limit
     :param complexity_step: the increase in the stream complexity limit per iteration
@@ -96,6 +98,7 @@ def solve_abstract(problem, constraints=PlanConstraints(), stream_info={}, repla
 
     :param max_skeletons: the maximum number of plan skeletons (max_skeletons=None indicates not adaptive)
     :param search_sample_ratio: the desired ratio of sample time / search time when max_skeletons!=None
+    :param num_plans: the maximum number of distinct optimistic plans per search when max_skeletons!=None
     :param bind: if True, propagates parameter bindings when max_skeletons=None
     :param max_failures: the maximum number of stream failures before switching phases when max_skeletons=None
 
@@ -103,6 +106,9 @@ def solve_abstract(problem, constraints=PlanConstraints(), stream_info={}, repla
     :param max_effort: the maximum amount of stream effort
     :param effort_weight: a multiplier for stream effort compared to action costs
     :param reorder: if True, reorder stream plans to minimize the expected sampling overhead
+    :param pipeline: if True, once sampling adds new evaluations, the next optimistic search runs in the background
+        on a snapshot of them while the skeleton queue continues to sample
+        (when max_skeletons!=None and there are no optimizers or fluent streams). Otherwise, search and sampling alternate
 
     :param visualize: if True, draw the constraint network and stream plan as a graphviz file
     :param verbose: if True, print the result of each stream application
@@ -139,17 +145,67 @@ def solve_abstract(problem, constraints=PlanConstraints(), stream_info={}, repla
         print('Warning, visualize=True requires pygraphviz. Setting visualize=False')
     if visualize:
         reset_visualizations()
-    streams, functions, negative, optimizers = partition_externals(externals, verbose=verbose)
-    eager_externals = list(filter(lambda e: e.info.eager, externals))
+    relevant_externals = prune_irrelevant_externals(domain, goal_exp, externals, verbose=verbose)
+    streams, functions, negative, optimizers = partition_externals(relevant_externals, verbose=verbose)
+    eager_externals = list(filter(lambda e: e.info.eager, relevant_externals))
     positive_externals = streams + functions + optimizers
     has_optimizers = bool(optimizers) # TODO: deprecate
     assert implies(has_optimizers, use_skeletons)
+    # Disabled axioms modify the domain and depend on the skeleton queue
+    has_fluents = any(external.is_fluent for external in relevant_externals) # Fluent streams also disable axioms
+    pipeline = pipeline and use_skeletons and not has_optimizers and not has_fluents
 
     ################
 
-    store = SolutionStore(evaluations, max_time, success_cost, verbose, max_memory=max_memory)
+    store = SolutionStore(evaluations, max_time, success_cost, verbose, max_memory=max_memory,
+                          search_fraction=search_fraction)
     skeleton_queue = SkeletonQueue(store, domain, disable=not has_optimizers)
     disabled = set() # Max skeletons after a solution
+
+    # Anytime searches report intermediate plans (as alternatives) and stop once a plan could succeed
+    search_kwargs.setdefault('terminate_cost', success_cost)
+    search_kwargs.setdefault('process_usages', store.process_usages)
+
+    # Stream efforts change with every stream call, so searches that depend on them are not reused
+    reuse_searches = REUSE_SEARCHES and (effort_weight is None) and (max_effort == INF)
+    search_from_fingerprint = {} # Only the latest search
+
+    def search(evaluations, complexity_limit):
+        if (max_skeletons is not None) and (len(skeleton_queue.skeletons) >= max_skeletons):
+            return OptSolution(INFEASIBLE, INFEASIBLE, INF), [] # TODO: apply elsewhere
+        fingerprint = None
+        if reuse_searches:
+            disabled_clusters = frozenset(frozenset(map(get_result_key, cluster)) for cluster in
+                                          extract_disabled_clusters(skeleton_queue)) if has_optimizers else None
+            fingerprint = get_search_fingerprint(evaluations, positive_externals, complexity_limit,
+                                                 min(store.best_cost, constraints.max_cost), disabled_clusters)
+            if fingerprint in search_from_fingerprint:
+                print('Reusing the previous search: nothing changed since')
+                opt_solution, alternatives = search_from_fingerprint[fingerprint]
+                return opt_solution, list(alternatives)
+        alternatives = []
+        optimistic_solve_fn = get_optimistic_solve_fn(goal_exp, domain, negative,
+                                                      replan_actions=replan_actions, reachieve=use_skeletons,
+                                                      max_cost=min(store.best_cost, constraints.max_cost),
+                                                      max_effort=max_effort, effort_weight=effort_weight,
+                                                      num_plans=num_plans if use_skeletons else 1,
+                                                      alternatives=alternatives if use_skeletons else None,
+                                                      deadline=store.deadline,
+                                                      **search_kwargs)
+        # TODO: just set unit effort for each stream beforehand
+        disabled_axioms = create_disabled_axioms(skeleton_queue) if has_optimizers else []
+        if disabled_axioms:
+            domain.axioms.extend(disabled_axioms)
+        opt_solution = iterative_plan_streams(evaluations, positive_externals,
+            optimistic_solve_fn, complexity_limit, deadline=store.deadline, max_effort=max_effort)
+        for axiom in disabled_axioms:
+            domain.axioms.remove(axiom)
+        if (fingerprint is not None) and (store.deadline.remaining_search_time() > 0): # Timeouts might differ
+            search_from_fingerprint.clear()
+            search_from_fingerprint[fingerprint] = (opt_solution, list(alternatives))
+        return opt_solution, alternatives
+
+    background = None # The search launched before the previous sampling phase
     while (not store.is_terminated()) and (num_iterations < max_iterations) and (complexity_limit <= max_complexity):
         num_iterations += 1
         eager_instantiator = Instantiator(eager_externals, evaluations) # Only update after an increase?
@@ -165,21 +221,23 @@ def solve_abstract(problem, constraints=PlanConstraints(), stream_info={}, repla
               'Eager Calls: {} | Cost: {:.3f} | Search Time: {:.3f} | Sample Time: {:.3f} | Total Time: {:.3f}'.format(
             num_iterations, complexity_limit, len(skeleton_queue.skeletons), len(skeleton_queue), len(disabled),
             len(evaluations), eager_calls, store.best_cost, store.search_time, store.sample_time, store.elapsed_time()))
-        optimistic_solve_fn = get_optimistic_solve_fn(goal_exp, domain, negative,
-                                                      replan_actions=replan_actions, reachieve=use_skeletons,
-                                                      max_cost=min(store.best_cost, constraints.max_cost),
-                                                      max_effort=max_effort, effort_weight=effort_weight, **search_kwargs)
-        # TODO: just set unit effort for each stream beforehand
-        if (max_skeletons is None) or (len(skeleton_queue.skeletons) < max_skeletons):
-            disabled_axioms = create_disabled_axioms(skeleton_queue) if has_optimizers else []
-            if disabled_axioms:
-                domain.axioms.extend(disabled_axioms)
-            stream_plan, opt_plan, cost = iterative_plan_streams(evaluations, positive_externals,
-                optimistic_solve_fn, complexity_limit, max_effort=max_effort)
-            for axiom in disabled_axioms:
-                domain.axioms.remove(axiom)
-        else:
-            stream_plan, opt_plan, cost = OptSolution(INFEASIBLE, INFEASIBLE, INF) # TODO: apply elsewhere
+        opt_solution = None
+        if background is not None:
+            # Sync point: the background search did not observe the evaluations sampled since its launch
+            opt_solution, alternatives = background.join()
+            if not is_plan(opt_solution.opt_plan) and (len(background.evaluations) != len(evaluations)):
+                opt_solution = None # Stale failures are recomputed rather than increasing the complexity
+            background = None
+        if (opt_solution is None) and (store.deadline.remaining_search_time() <= 0):
+            # Otherwise, every search immediately fails and the complexity increases in a busy loop
+            if not use_skeletons or not skeleton_queue or (store.deadline.remaining_sample_time() <= 0):
+                break
+            print('Search time exhausted: sampling the existing skeletons')
+            skeleton_queue.process(FAILED, FAILED, INF, complexity_limit, store.deadline.remaining_sample_time())
+            continue
+        if opt_solution is None:
+            opt_solution, alternatives = search(evaluations, complexity_limit)
+        stream_plan, opt_plan, cost = opt_solution
 
         ################
 
@@ -189,7 +247,6 @@ def solve_abstract(problem, constraints=PlanConstraints(), stream_info={}, repla
         #                                       [s for s in synthesizers if not s.post_only])
         #stream_plan = recover_optimistic_outputs(stream_plan)
         if reorder:
-            # TODO: this blows up memory wise for long stream plans
             stream_plan = reorder_stream_plan(store, stream_plan)
 
         num_optimistic = sum(r.optimistic for r in stream_plan) if stream_plan else 0
@@ -226,11 +283,43 @@ def solve_abstract(problem, constraints=PlanConstraints(), stream_info={}, repla
                 get_length(optimizer_plan), compute_plan_effort(optimizer_plan), optimizer_plan))
             skeleton_queue.new_skeleton(optimizer_plan, opt_plan, cost)
 
+        if is_plan(stream_plan) and PRUNE_DOMINATED and (not has_optimizers) and \
+                check_dominated(skeleton_queue, stream_plan, cost):
+            print('Dominated skeleton ({}, {:.3f}): {}'.format(
+                get_length(action_plan), cost, str_from_plan(action_plan)))
+            stream_plan = opt_plan = FAILED # Samples the existing skeletons instead
+
+        for alt_stream_plan, alt_opt_plan, alt_cost in alternatives:
+            # Additional skeletons from the same grounding (only the best plan is processed below)
+            alt_stream_plan = combine_optimizers(evaluations, alt_stream_plan)
+            if PRUNE_DOMINATED and (not has_optimizers) and check_dominated(skeleton_queue, alt_stream_plan, alt_cost):
+                continue
+            if reorder:
+                alt_stream_plan = reorder_stream_plan(store, alt_stream_plan)
+            print('Alternative plan ({}, {:.3f}): {}'.format(
+                get_length(alt_opt_plan.action_plan), alt_cost, str_from_plan(alt_opt_plan.action_plan)))
+            skeleton_queue.new_skeleton(alt_stream_plan, alt_opt_plan, alt_cost)
+
         allocated_sample_time = (search_sample_ratio * store.search_time) - store.sample_time \
             if len(skeleton_queue.skeletons) <= max_skeletons else INF
-        if skeleton_queue.process(stream_plan, opt_plan, cost, complexity_limit, allocated_sample_time) is INFEASIBLE:
+        allocated_sample_time = min(allocated_sample_time, store.deadline.remaining_sample_time())
+        backgrounds = []
+        def launch_search():
+            # Otherwise, the search would observe the same evaluations as the previous search
+            with Unlocked(SOLVE_LOCK): # Lets the search acquire the lock first
+                backgrounds.append(BackgroundSearch(search, evaluations, complexity_limit=complexity_limit))
+        new_fn = launch_search if pipeline and (num_iterations < max_iterations) else None
+        with SOLVE_LOCK: # Excludes the background search, except while it waits on its planner
+            status = skeleton_queue.process(stream_plan, opt_plan, cost, complexity_limit,
+                                            allocated_sample_time, new_fn=new_fn)
+        if backgrounds:
+            background = backgrounds[0]
+        if status is INFEASIBLE:
             break
 
+    if background is not None:
+        background.join() # Prevents the search from outliving the solve
+
     ################
 
     summary = store.export_summary()
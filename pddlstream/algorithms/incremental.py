@@ -3,36 +3,41 @@ from collections import Counter
 import time
 
 from pddlstream.algorithms.algorithm import parse_problem
-from pddlstream.algorithms.common import add_facts, add_certified, SolutionStore, UNKNOWN_EVALUATION
+from pddlstream.algorithms.advanced import prune_irrelevant_externals
+from pddlstream.algorithms.common import add_facts, add_certified, SolutionStore, UNKNOWN_EVALUATION, BackgroundSearch
 from pddlstream.algorithms.constraints import PlanConstraints
 from pddlstream.algorithms.downward import get_problem, task_from_domain_problem
 from pddlstream.algorithms.instantiate_task import sas_from_pddl, instantiate_task
 from pddlstream.algorithms.instantiation import Instantiator
-from pddlstream.algorithms.search import abstrips_solve_from_task
+from pddlstream.algorithms.search import abstrips_solve_from_task, apply_deadline
 from pddlstream.language.constants import is_plan
 from pddlstream.language.conversion import obj_from_pddl_plan
 from pddlstream.language.attachments import has_attachments, compile_fluents_as_attachments, solve_pyplanners
 from pddlstream.language.statistics import load_stream_statistics, write_stream_statistics
 from pddlstream.language.temporal import solve_tfd, SimplifiedDomain
 from pddlstream.language.write_pddl import get_problem_pddl
-from pddlstream.utils import INF, Verbose, str_from_object, elapsed_time
+from pddlstream.utils import INF, Verbose, str_from_object, elapsed_time, SOLVE_LOCK
 
 UPDATE_STATISTICS = False
 
-def solve_temporal(evaluations, goal_exp, domain, debug=False, **kwargs):
+def solve_temporal(evaluations, goal_exp, domain, debug=False, deadline=None, process_usages=None, **kwargs):
     assert isinstance(domain, SimplifiedDomain)
     problem = get_problem_pddl(evaluations, goal_exp, domain.pddl)
-    return solve_tfd(domain.pddl, problem, debug=debug)
+    return solve_tfd(domain.pddl, problem, debug=debug, deadline=deadline, process_usages=process_usages)
 
-def solve_sequential(evaluations, goal_exp, domain, unit_costs=False, debug=False, **search_args):
+def solve_sequential(evaluations, goal_exp, domain, unit_costs=False, debug=False, deadline=None,
+                     process_usages=None, **search_args):
     problem = get_problem(evaluations, goal_exp, domain, unit_costs)
-    task = task_from_domain_problem(domain, problem)
     if has_attachments(domain):
+        # Attachments read fluent predicates that might not appear in any condition
+        task = task_from_domain_problem(domain, problem)
         with Verbose(debug):
             instantiated = instantiate_task(task)
-        return solve_pyplanners(instantiated, **search_args)
+        return solve_pyplanners(instantiated, **apply_deadline(search_args, deadline))
+    task = task_from_domain_problem(domain, problem, prune=True, verbose=debug)
     sas_task = sas_from_pddl(task, debug=debug)
-    return abstrips_solve_from_task(sas_task, debug=debug, **search_args)
+    return abstrips_solve_from_task(sas_task, debug=debug, deadline=deadline,
+                                    process_usages=process_usages, **search_args)
 
 def solve_finite(evaluations, goal_exp, domain, **kwargs):
     if isinstance(domain, SimplifiedDomain):
@@ -69,12 +74,14 @@ def process_stream_queue(instantiator, store, complexity_limit=INF, verbose=Fals
     instances = []
     results = []
     num_successes = 0
-    while not store.is_terminated() and instantiator and (instantiator.min_complexity() <= complexity_limit):
-        instance = instantiator.pop_stream()
-        if instance.enumerated:
-            continue
-        instances.append(instance)
-        new_results = process_instance(instantiator, store, instance, verbose=verbose)
+    while not store.is_terminated() and (store.deadline.remaining_sample_time() > 0) and \
+            instantiator and (instantiator.min_complexity() <= complexity_limit):
+        with SOLVE_LOCK: # Each step, so that a background search can adopt a plan promptly
+            instance = instantiator.pop_stream()
+            if instance.enumerated:
+                continue
+            instances.append(instance)
+            new_results = process_instance(instantiator, store, instance, verbose=verbose)
         results.extend(new_results)
         num_successes += bool(new_results) # TODO: max_results?
     if verbose:
@@ -97,9 +104,9 @@ def process_stream_queue(instantiator, store, complexity_limit=INF, verbose=Fals
 
 def solve_incremental(problem, constraints=PlanConstraints(),
                       unit_costs=False, success_cost=INF,
-                      max_iterations=INF, max_time=INF, max_memory=INF,
+                      max_iterations=INF, max_time=INF, max_memory=INF, search_fraction=None,
                       initial_complexity=0, complexity_step=1, max_complexity=INF,
-                      verbose=False, **search_kwargs):
+                      speculate=False, verbose=False, **search_kwargs):
     """
     Solves a PDDLStream problem by alternating between applying all possible streams and searching
     :param problem: a PDDLStream problem
@@ -111,11 +118,15 @@ def solve_incremental(problem, constraints=PlanConstraints(),
     :param max_time: the maximum runtime
     :param max_iterations: the maximum number of search iterations
     :param max_memory: the maximum amount of memory
+    :param search_fraction: if not None, the fraction of max_time reserved for search (the rest is for sampling)
 
     :param initial_complexity: the initial stream complexity limit
     :param complexity_step: the increase in the stream complexity limit per iteration
     :param max_complexity: the maximum stream complexity limit
 
+    :param speculate: if True, each search runs in the background while the next complexity level is sampled,
+        and a plan is adopted as soon as it is found. The search only overlaps with sampling while it waits on
+        its planner (see BackgroundSearch), so the caches of the translation are never accessed concurrently
     :param verbose: if True, print the result of each stream application
     :param search_kwargs: keyword args for the search subroutine
 
@@ -129,24 +140,36 @@ def solve_incremental(problem, constraints=PlanConstraints(),
     # TODO: warning if optimizers are present
     evaluations, goal_expression, domain, externals = parse_problem(
         problem, constraints=constraints, unit_costs=unit_costs)
-    store = SolutionStore(evaluations, max_time, success_cost, verbose, max_memory=max_memory) # TODO: include other info here?
+    store = SolutionStore(evaluations, max_time, success_cost, verbose, max_memory=max_memory,
+                          search_fraction=search_fraction) # TODO: include other info here?
     if UPDATE_STATISTICS:
         load_stream_statistics(externals)
     static_externals = compile_fluents_as_attachments(domain, externals)
+    static_externals = prune_irrelevant_externals(domain, goal_expression, static_externals, verbose=verbose)
     num_iterations = num_calls = 0
     complexity_limit = initial_complexity
     instantiator = Instantiator(static_externals, evaluations)
     num_calls += process_stream_queue(instantiator, store, complexity_limit, verbose=verbose)
+
+    def search(evaluations, max_cost=INF):
+        plan, cost = solve_finite(evaluations, goal_expression, domain, deadline=store.deadline,
+                                  max_cost=max_cost, process_usages=store.process_usages, **search_kwargs)
+        if is_plan(plan):
+            store.add_plan(plan, cost) # Terminates the sampling of process_stream_queue when solved
+
     while not store.is_terminated() and (num_iterations < max_iterations) and (complexity_limit <= max_complexity):
         num_iterations += 1
         print('Iteration: {} | Complexity: {} | Calls: {} | Evaluations: {} | Solved: {} | Cost: {:.3f} | '
               'Search Time: {:.3f} | Sample Time: {:.3f} | Time: {:.3f}'.format(
             num_iterations, complexity_limit, num_calls, len(evaluations),
             store.has_solution(), store.best_cost, store.search_time, store.sample_time, store.elapsed_time()))
-        plan, cost = solve_finite(evaluations, goal_expression, domain,
-                                  max_cost=min(store.best_cost, constraints.max_cost), **search_kwargs)
-        if is_plan(plan):
-            store.add_plan(plan, cost)
+        max_cost = min(store.best_cost, constraints.max_cost)
+        background = None
+        if speculate and instantiator:
+            # Searches the current evaluations while the next complexity level is sampled
+            background = BackgroundSearch(search, evaluations, max_cost=max_cost)
+        else:
+            search(evaluations, max_cost=max_cost)
         if not instantiator:
             break
         if complexity_step is None:
@@ -155,6 +178,8 @@ def solve_incremental(problem, constraints=PlanConstraints(),
         else:
             complexity_limit += complexity_step
         num_calls += process_stream_queue(instantiator, store, complexity_limit, verbose=verbose)
+        if background is not None:
+            background.join() # The sampled evaluations are searched in the next iteration
     #retrace_stream_plan(store, domain, goal_expression)
     #print('Final queue size: {}'.format(len(instantiator)))
 
@@ -1,23 +1,28 @@
 from __future__ import print_function
 
+import copy
 import os
-from collections import namedtuple, defaultdict, deque, Counter
+from collections import namedtuple, defaultdict, deque, Counter, OrderedDict
 from time import time
+from weakref import WeakKeyDictionary
 
 from pddlstream.algorithms.downward import get_literals, get_precondition, get_fluents, get_function_assignments, \
     TRANSLATE_OUTPUT, parse_sequential_domain, parse_problem, task_from_domain_problem, GOAL_NAME, literal_holds, \
-    get_conjunctive_parts, get_conditional_effects
-from pddlstream.algorithms.relation import Relation, compute_order, solve_satisfaction
-from pddlstream.language.constants import is_parameter
+    get_conjunctive_parts, get_conditional_effects, summarize_operator, get_condition_predicates, LazyModule
+from pddlstream.algorithms.relation import compute_order
+from pddlstream.language.constants import is_parameter, EQ
 from pddlstream.utils import flatten, apply_mapping, MockSet, elapsed_time, Verbose, safe_remove, ensure_dir, \
     str_from_object, user_input, Profiler
 
-import pddl
-import instantiate
-import translate
-import normalize
+pddl = LazyModule('pddl')
+instantiate = LazyModule('instantiate')
+translate = LazyModule('translate')
+normalize = LazyModule('normalize')
 
 FD_INSTANTIATE = True
+INCREMENTAL_INSTANTIATE = True # Extends the previous grounding of each operator when its static atoms only grow
+SAS_CACHE_SIZE = 16 # Number of translated SAS+ tasks retained (0 disables the cache)
+CACHE_INVARIANTS = True # Reuses invariants across tasks that share a normalized domain
 
 InstantiatedTask = namedtuple('InstantiatedTask', ['task', 'atoms', 'actions', 'axioms',
                                                    'reachable_action_params', 'goal_list'])
@@ -37,24 +42,91 @@ def get_goal_instance(goal):
 def get_constants(atom):
     return tuple((i, a) for i, a in enumerate(atom.args) if not is_parameter(a))
 
-def instantiate_condition(action, is_static, args_from_predicate):
-    parameters = {p.name for p in action.parameters}
-    #if not parameters:
-    #    yield {}
-    #    return
-    static_conditions = list(filter(is_static, get_literals(get_precondition(action))))
-    static_parameters = set(filter(is_parameter, flatten(atom.args for atom in static_conditions)))
+def get_condition_key(condition):
+    return condition.predicate, get_constants(condition)
+
+JoinPlan = namedtuple('JoinPlan', ['fluent_predicates', 'conditions', 'keys', 'negated'])
+JOIN_PLAN_FROM_OPERATOR = WeakKeyDictionary() # Compiled once per operator
+
+def get_join_plan(operator, fluent_predicates):
+    join_plan = JOIN_PLAN_FROM_OPERATOR.get(operator)
+    if (join_plan is not None) and (join_plan.fluent_predicates == fluent_predicates):
+        return join_plan
+    literals = get_literals(get_precondition(operator))
+    conditions = [literal for literal in literals
+                  if isinstance(literal, pddl.Atom) and (literal.predicate not in fluent_predicates)]
+    parameters = {p.name for p in operator.parameters}
+    static_parameters = set(filter(is_parameter, flatten(atom.args for atom in conditions)))
     if not (parameters <= static_parameters):
         raise NotImplementedError('Could not instantiate action {} due to parameters: {}'.format(
-            action.name, str_from_object(parameters - static_parameters)))
-    atoms_from_cond = {condition: args_from_predicate[condition.predicate, get_constants(condition)]
-                       for condition in static_conditions}
-    conditions, atoms = zip(*atoms_from_cond.items())
-    relations = [Relation(conditions[index].args, atoms[index])
-                 for index in compute_order(conditions, atoms)]
-    solution = solve_satisfaction(relations)
-    for element in solution.body:
-        yield solution.get_mapping(element)
+            operator.name, str_from_object(parameters - static_parameters)))
+    negated = [literal for literal in literals
+               if isinstance(literal, pddl.NegatedAtom) and (literal.predicate not in fluent_predicates)]
+    join_plan = JoinPlan(fluent_predicates, conditions, list(map(get_condition_key, conditions)), negated)
+    JOIN_PLAN_FROM_OPERATOR[operator] = join_plan
+    return join_plan
+
+def join_conditions(conditions, atom_lists, negated=[], args_from_predicate={}):
+    # Nested-loop join that probes a hash index on the already-bound arguments of each condition
+    # Negated static conditions filter the partial assignments as soon as their parameters are bound
+    variables = []
+    position_from_variable = {}
+    elements = [tuple()]
+    remaining_negated = list(negated)
+    for index in compute_order(conditions, atom_lists):
+        args = conditions[index].args
+        bound, free, repeated = [], [], []
+        first_from_variable = {}
+        for i, arg in enumerate(args):
+            if not is_parameter(arg):
+                continue # Constants were filtered by the condition key
+            if arg in position_from_variable:
+                bound.append((i, position_from_variable[arg]))
+            elif arg in first_from_variable:
+                repeated.append((i, first_from_variable[arg]))
+            else:
+                first_from_variable[arg] = i
+                free.append(i)
+        values_from_key = defaultdict(list)
+        for atom_args in atom_lists[index]:
+            if all(atom_args[i] == atom_args[j] for i, j in repeated):
+                values_from_key[tuple(atom_args[i] for i, _ in bound)].append(tuple(atom_args[i] for i in free))
+        elements = [element + values for element in elements
+                    for values in values_from_key.get(tuple(element[j] for _, j in bound), [])]
+        for i in free:
+            position_from_variable[args[i]] = len(variables)
+            variables.append(args[i])
+        for literal in list(remaining_negated):
+            if all(not is_parameter(arg) or (arg in position_from_variable) for arg in literal.args):
+                remaining_negated.remove(literal)
+                positions = [position_from_variable.get(arg) for arg in literal.args]
+                static_args = args_from_predicate[literal.predicate]
+                elements = [element for element in elements if tuple(
+                    arg if position is None else element[position]
+                    for arg, position in zip(literal.args, positions)) not in static_args]
+        if not elements:
+            return
+    for element in elements:
+        yield dict(zip(variables, element))
+
+def instantiate_condition(action, fluent_predicates, args_from_predicate, old_args_from_key=None, prune_negated=False):
+    join_plan = get_join_plan(action, fluent_predicates)
+    conditions, keys = join_plan.conditions, join_plan.keys
+    if not conditions:
+        yield {}
+        return
+    negated = join_plan.negated if prune_negated else []
+    atoms = [args_from_predicate[key] for key in keys]
+    atom_lists = [atoms]
+    if old_args_from_key is not None:
+        # Semi-naive evaluation: only mappings that use at least one new atom (the first at index i)
+        old_atoms = [old_args_from_key.get(key, frozenset()) for key in keys]
+        atom_lists = [old_atoms[:i] + [set(atoms[i]) - old_atoms[i]] + list(atoms[i+1:])
+                      for i in range(len(conditions))]
+    for condition_atoms in atom_lists:
+        if all(condition_atoms):
+            for mapping in join_conditions(conditions, condition_atoms, negated, args_from_predicate):
+                yield mapping
 
 def get_reachable_action_params(instantiated_actions):
     # TODO: use pddl_from_instance
@@ -112,6 +184,58 @@ def get_achieving_axioms(state, operators, negated_from_name={}):
 
 ##################################################
 
+OperatorGrounding = namedtuple('OperatorGrounding', ['context', 'args_from_key', 'function_assignments', 'instances'])
+GROUNDING_FROM_OPERATOR = WeakKeyDictionary() # Stream domains share the original operators
+
+def get_cost_assignments(operator, function_assignments):
+    if not isinstance(operator, pddl.Action) or (operator.cost is None) or \
+            not isinstance(operator.cost.expression, pddl.PrimitiveNumericExpression):
+        return {}
+    symbol = operator.cost.expression.symbol
+    return {head: value for head, value in function_assignments.items() if head.symbol == symbol}
+
+def copy_instance(instance):
+    # Callers modify instances in place (e.g. costs, effects, and preconditions)
+    new_instance = copy.copy(instance)
+    for attribute in ['precondition', 'add_effects', 'del_effects', 'condition']:
+        if isinstance(getattr(instance, attribute, None), list):
+            setattr(new_instance, attribute, list(getattr(instance, attribute)))
+    return new_instance
+
+def is_monotonic(operator, fluent_predicates):
+    # Instances remain valid as static atoms are added unless static atoms are negated or condition effects
+    if not summarize_operator(operator).prunable: # Quantifiers range over objects
+        return False
+    if any(literal.negated and (literal.predicate != EQ) and (literal.predicate not in fluent_predicates)
+           for literal in get_literals(get_precondition(operator))):
+        return False
+    effects = operator.effects if isinstance(operator, pddl.Action) else []
+    return all(get_condition_predicates(effect.condition) <= set(fluent_predicates) for effect in effects)
+
+def ground_operator(operator, args_from_predicate, instantiate_fn, context, function_assignments={}):
+    # Extends the previous grounding when this operator's static atoms only grew since the last call
+    fluent_predicates, prune_static = context[:2]
+    if not INCREMENTAL_INSTANTIATE or not is_monotonic(operator, fluent_predicates):
+        mappings = instantiate_condition(operator, fluent_predicates, args_from_predicate, prune_negated=prune_static)
+        return list(filter(None, (instantiate_fn(operator, mapping) for mapping in mappings)))
+    keys = set(get_join_plan(operator, fluent_predicates).keys)
+    args_from_key = {key: frozenset(args_from_predicate[key]) for key in keys}
+    cost_assignments = get_cost_assignments(operator, function_assignments)
+    grounding = GROUNDING_FROM_OPERATOR.get(operator)
+    if (grounding is not None) and (grounding.context == context) and \
+            all(grounding.args_from_key[key] <= args_from_key[key] for key in keys) and \
+            all(cost_assignments.get(head) == value for head, value in grounding.function_assignments.items()):
+        instances = list(grounding.instances)
+        mappings = instantiate_condition(operator, fluent_predicates, args_from_predicate, grounding.args_from_key,
+                                         prune_negated=prune_static)
+    else:
+        instances = []
+        mappings = instantiate_condition(operator, fluent_predicates, args_from_predicate,
+                                         prune_negated=prune_static)
+    instances.extend(filter(None, (instantiate_fn(operator, mapping) for mapping in mappings)))
+    GROUNDING_FROM_OPERATOR[operator] = OperatorGrounding(context, args_from_key, cost_assignments, instances)
+    return list(map(copy_instance, instances))
+
 def instantiate_domain(task, prune_static=True):
     fluent_predicates = get_fluents(task)
     is_static = lambda a: isinstance(a, pddl.Atom) and (a.predicate not in fluent_predicates)
@@ -136,19 +260,19 @@ def instantiate_domain(task, prune_static=True):
             if all(atom.args[i] == o for i, o in constants):
                 args_from_predicate[atom.predicate, constants].add(atom.args)
 
+    context = (frozenset(fluent_predicates), prune_static, task.use_min_cost_metric)
+    instantiate_action = lambda action, variable_mapping: action.instantiate(
+        variable_mapping, init_facts, fluent_facts, type_to_objects,
+        task.use_min_cost_metric, function_assignments, predicate_to_atoms)
     instantiated_actions = []
     for action in task.actions:
-        for variable_mapping in instantiate_condition(action, is_static, args_from_predicate):
-            inst_action = action.instantiate(variable_mapping, init_facts, fluent_facts, type_to_objects,
-                                             task.use_min_cost_metric, function_assignments, predicate_to_atoms)
-            if inst_action:
-                instantiated_actions.append(inst_action)
+        instantiated_actions.extend(ground_operator(action, args_from_predicate,
+                                                    instantiate_action, context, function_assignments))
+    instantiate_axiom = lambda axiom, variable_mapping: axiom.instantiate(variable_mapping, init_facts, fluent_facts)
     instantiated_axioms = []
     for axiom in task.axioms:
-        for variable_mapping in instantiate_condition(axiom, is_static, args_from_predicate):
-            inst_axiom = axiom.instantiate(variable_mapping, init_facts, fluent_facts)
-            if inst_axiom:
-                instantiated_axioms.append(inst_axiom)
+        instantiated_axioms.extend(ground_operator(axiom, args_from_predicate,
+                                                   instantiate_axiom, context))
 
     reachable_facts, reachable_operators = get_achieving_axioms(init_facts, instantiated_actions + instantiated_axioms)
     atoms = {atom.positive() for atom in (init_facts | set(reachable_facts)) if isinstance(atom, pddl.Literal)}
@@ -162,6 +286,45 @@ def instantiate_domain(task, prune_static=True):
 
 ##################################################
 
+class Exploration(object):
+    # Datalog rules (with their join indices) and the model computed so far
+    def __init__(self, prog):
+        import build_model
+        self.facts = set()
+        self.rules = build_model.convert_rules(prog)
+        self.unifier = build_model.Unifier(self.rules)
+        self.queue = build_model.Queue([])
+    def extend(self, facts):
+        for fact in sorted(set(facts) - self.facts):
+            self.queue.push(fact.predicate, fact.args)
+        self.facts.update(facts)
+        while self.queue: # Semi-naive: only joins involving newly derived atoms
+            next_atom = self.queue.pop()
+            for rule, cond_index in self.unifier.unify(next_atom):
+                rule.update_index(next_atom, cond_index)
+                rule.fire(next_atom, cond_index, self.queue.push)
+        return self.queue.queue
+
+EXPLORATION_CACHE_SIZE = 4
+EXPLORATION_FROM_RULES = OrderedDict()
+
+def explore_incrementally(task):
+    # Resumes the fixpoint of a previous call with identical rules when its facts are a subset
+    import pddl_to_prolog
+    prog = pddl_to_prolog.translate(task)
+    rules_key = tuple(map(str, prog.rules))
+    facts = {fact.atom for fact in prog.facts}
+    exploration = EXPLORATION_FROM_RULES.pop(rules_key, None)
+    if (exploration is None) or not (exploration.facts <= facts):
+        exploration = Exploration(prog)
+    model = exploration.extend(facts)
+    EXPLORATION_FROM_RULES[rules_key] = exploration # Most recently used is last
+    while EXPLORATION_CACHE_SIZE < len(EXPLORATION_FROM_RULES):
+        EXPLORATION_FROM_RULES.popitem(last=False)
+    return instantiate.instantiate(task, list(model))
+
+##################################################
+
 def dump_instantiated(instantiated):
     print('Instantiated frequencies:\n'
           'Atoms: {}\n'
@@ -178,7 +341,8 @@ def instantiate_task(task, check_infeasible=True, use_fd=FD_INSTANTIATE, **kwarg
     #with Profiler(field='tottime', num=25):
     if use_fd:
         # TODO: recover relaxed reachability (from model)
-        relaxed_reachable, atoms, actions, axioms, reachable_action_params = instantiate.explore(task)
+        explore = explore_incrementally if INCREMENTAL_INSTANTIATE else instantiate.explore
+        relaxed_reachable, atoms, actions, axioms, reachable_action_params = explore(task)
     else:
         relaxed_reachable, atoms, actions, axioms = instantiate_domain(task, **kwargs)
         reachable_action_params = get_reachable_action_params(actions)
@@ -199,9 +363,115 @@ def instantiate_task(task, check_infeasible=True, use_fd=FD_INSTANTIATE, **kwarg
 
 ##################################################
 
-def sas_from_instantiated(instantiated_task):
+INVARIANTS_FROM_SCHEMA = {}
+INVARIANT_STATISTICS = Counter()
+
+def get_parameters_key(parameters):
+    return tuple((parameter.name, parameter.type_name) for parameter in parameters)
+
+def get_schema_key(task):
+    # Invariant synthesis only depends on the (normalized) operator schemas and predicates
+    actions = tuple((action.name, get_parameters_key(action.parameters), action.precondition,
+                     tuple((get_parameters_key(effect.parameters), effect.condition, effect.literal)
+                           for effect in action.effects)) for action in task.actions)
+    axioms = tuple((axiom.name, get_parameters_key(axiom.parameters), axiom.num_external_parameters,
+                    axiom.condition) for axiom in task.axioms)
+    predicates = tuple((predicate.name, len(predicate.arguments)) for predicate in task.predicates)
+    return actions, axioms, predicates
+
+def get_groups(task, reachable_action_params):
+    # Invariants proven for a superset of the reachable action parameters remain invariants
+    from invariant_finder import find_invariants, useful_groups
     import timers
+    key = get_schema_key(task)
+    action_params = [set(map(tuple, reachable_action_params.get(action, []))) for action in task.actions]
+    if key in INVARIANTS_FROM_SCHEMA:
+        cached_params, invariants = INVARIANTS_FROM_SCHEMA[key]
+        if all(params <= cached for params, cached in zip(action_params, cached_params)):
+            INVARIANT_STATISTICS['hits'] += 1
+            return list(useful_groups(invariants, task.init))
+        # Extending the parameters ensures the invariants also apply to the previous tasks
+        action_params = [params | cached for params, cached in zip(action_params, cached_params)]
+    INVARIANT_STATISTICS['misses'] += 1
+    extended_params = defaultdict(list, {action: list(params) for action, params
+                                         in zip(task.actions, action_params)})
+    with timers.timing("Finding invariants", block=True):
+        invariants = sorted(find_invariants(task, extended_params))
+    INVARIANTS_FROM_SCHEMA[key] = (action_params, invariants)
+    return list(useful_groups(invariants, task.init))
+
+def compute_groups(task, atoms, reachable_action_params):
+    # Mirrors fact_groups.compute_groups except that the invariants are cached
     import fact_groups
+    import timers
+    if not CACHE_INVARIANTS:
+        return fact_groups.compute_groups(task, atoms, reachable_action_params)
+    groups = get_groups(task, reachable_action_params)
+    print('Invariant cache hits: {}/{}'.format(
+        INVARIANT_STATISTICS['hits'], sum(INVARIANT_STATISTICS.values())))
+    with timers.timing("Instantiating groups"):
+        groups = fact_groups.instantiate_groups(groups, task, atoms)
+    groups = fact_groups.sort_groups(groups)
+    with timers.timing("Collecting mutex groups"):
+        mutex_groups = fact_groups.collect_all_mutex_groups(groups, atoms)
+    with timers.timing("Choosing groups", block=True):
+        groups = fact_groups.choose_groups(groups, atoms)
+    groups = fact_groups.sort_groups(groups)
+    with timers.timing("Building translation key"):
+        translation_key = fact_groups.build_translation_key(groups)
+    return groups, mutex_groups, translation_key
+
+##################################################
+
+# The translation caches are only accessed while holding SOLVE_LOCK during a background search
+SAS_CACHE = OrderedDict()
+SAS_CACHE_STATISTICS = Counter()
+
+def get_instantiated_key(instantiated_task):
+    # Canonical representation of everything that the translation reads
+    task, atoms, actions, axioms, reachable_action_params, goal_list = instantiated_task
+    init = frozenset(fact for fact in task.init if isinstance(fact, pddl.Literal))
+    action_keys = tuple((action.name, tuple(action.precondition),
+                         tuple((tuple(conditions), effect) for conditions, effect in action.add_effects),
+                         tuple((tuple(conditions), effect) for conditions, effect in action.del_effects),
+                         action.cost) for action in actions)
+    axiom_keys = tuple((axiom.name, tuple(axiom.condition), axiom.effect) for axiom in axioms)
+    return init, frozenset(atoms), tuple(goal_list), action_keys, axiom_keys, task.use_min_cost_metric
+
+def get_sas_hit_rate():
+    num_calls = SAS_CACHE_STATISTICS['hits'] + SAS_CACHE_STATISTICS['misses']
+    return float(SAS_CACHE_STATISTICS['hits']) / num_calls if num_calls else 0.
+
+def sas_from_instantiated(instantiated_task, metric=None, verbose=False):
+    # The returned SAS+ task might be shared and thus should not be modified in place
+    # metric: if not None, overrides whether the task uses action costs (on a shallow copy)
+    if not instantiated_task or (SAS_CACHE_SIZE <= 0):
+        sas_task = translate_instantiated(instantiated_task)
+        if metric is not None:
+            sas_task.metric = metric
+        return sas_task
+    start_time = time()
+    key = get_instantiated_key(instantiated_task)
+    if key in SAS_CACHE:
+        SAS_CACHE_STATISTICS['hits'] += 1
+        sas_task = SAS_CACHE.pop(key)
+    else:
+        SAS_CACHE_STATISTICS['misses'] += 1
+        sas_task = translate_instantiated(instantiated_task)
+    SAS_CACHE[key] = sas_task # Most recently used is last
+    while SAS_CACHE_SIZE < len(SAS_CACHE):
+        SAS_CACHE.popitem(last=False)
+    if verbose:
+        print('SAS cache hits: {}/{} ({:.3f}) | Time: {:.3f}s'.format(
+            SAS_CACHE_STATISTICS['hits'], sum(SAS_CACHE_STATISTICS.values()),
+            get_sas_hit_rate(), elapsed_time(start_time)))
+    if (metric is not None) and (sas_task.metric != metric):
+        sas_task = copy.copy(sas_task)
+        sas_task.metric = metric
+    return sas_task
+
+def translate_instantiated(instantiated_task):
+    import timers
     import options
     import simplify
     import variable_order
@@ -216,7 +486,7 @@ def sas_from_instantiated(instantiated_task):
 
     # TODO: option to skip and just use binary variables
     with timers.timing("Computing fact groups", block=True):
-        groups, mutex_groups, translation_key = fact_groups.compute_groups(
+        groups, mutex_groups, translation_key = compute_groups(
             task, atoms, reachable_action_params)
 
     with timers.timing("Building STRIPS to SAS dictionary"):
@@ -281,8 +551,8 @@ def sas_from_pddl(task, debug=False):
     with Verbose(debug):
         instantiated = instantiate_task(task)
         #instantiated = convert_instantiated(instantiated)
-        sas_task = sas_from_instantiated(instantiated)
-        sas_task.metric = task.use_min_cost_metric # TODO: are these sometimes not equal?
+        sas_task = sas_from_instantiated(instantiated, metric=task.use_min_cost_metric, # TODO: are these sometimes not equal?
+                                         verbose=debug)
     return sas_task
 
 
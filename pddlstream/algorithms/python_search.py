@@ -0,0 +1,271 @@
+from __future__ import print_function
+
+import re
+
+from collections import defaultdict, namedtuple
+from heapq import heappush, heappop
+from itertools import count
+from time import time
+
+from pddlstream.algorithms.downward import DEFAULT_PLANNER, DEFAULT_MAX_TIME, SEARCH_OPTIONS, USE_FORBID, \
+    get_cost_scale, scale_cost, parse_action, is_portfolio
+from pddlstream.utils import INF, elapsed_time
+
+# In-process search directly on the SASTask (avoids starting FastDownward for small tasks)
+# Opt-in because it only approximates FastDownward (see python_search)
+MAX_PYTHON_SIZE = 0 # Maximum number of operators and axioms to search in-process (0 disables)
+TIME_PERIOD = 100 # Number of expansions between time checks
+
+# FastDownward configurations that the in-process search reproduces (lazy searches are left to FastDownward)
+OPTIMAL_PLANNERS = ['dijkstra', 'max-astar', 'lmcut-astar'] # Uniform-cost search
+ASTAR_REGEX = r'^ff-astar(\d*)$' # Eager A* (weighted with preferred operators when suffixed by the weight)
+GREEDY_REGEX = r'^ff-eager(-pref)?$' # Eager greedy best-first search
+
+UnaryOperator = namedtuple('UnaryOperator', ['index', 'conditions', 'effect', 'cost'])
+SearchConfig = namedtuple('SearchConfig', ['heuristic', 'weight', 'preferred']) # weight=None is greedy
+
+##################################################
+
+def get_search_config(planner):
+    if planner in OPTIMAL_PLANNERS:
+        return SearchConfig('blind', 0, False)
+    match = re.match(ASTAR_REGEX, planner)
+    if match is not None:
+        weight, = match.groups()
+        return SearchConfig('ff', int(weight) if weight else 1, bool(weight))
+    match = re.match(GREEDY_REGEX, planner)
+    if match is not None:
+        preferred, = match.groups()
+        return SearchConfig('ff', None, preferred is not None)
+    return None
+
+def use_python_search(sas_task, planner=DEFAULT_PLANNER, hierarchy=[], **kwargs):
+    if USE_FORBID or hierarchy or is_portfolio(planner) or (planner not in SEARCH_OPTIONS) or \
+            (get_search_config(planner) is None):
+        return False
+    return (len(sas_task.operators) + len(sas_task.axioms)) <= MAX_PYTHON_SIZE
+
+def get_operator_cost(sas_task, operator):
+    # Matches the plan cost that FastDownward reports
+    return operator.cost if sas_task.metric else 1
+
+##################################################
+
+def get_derived_variables(sas_task):
+    return {var for var, layer in enumerate(sas_task.variables.axiom_layers) if layer != -1}
+
+def get_axiom_fn(sas_task):
+    # Derived variables are reset to their default values and then stratified by layer
+    derived_variables = get_derived_variables(sas_task)
+    axioms_from_layer = defaultdict(list)
+    for axiom in sas_task.axioms:
+        var, _ = axiom.effect
+        axioms_from_layer[sas_task.variables.axiom_layers[var]].append(axiom)
+    layers = sorted(axioms_from_layer)
+
+    def fn(values):
+        for var in derived_variables:
+            values[var] = sas_task.init.values[var]
+        for layer in layers:
+            changed = True
+            while changed:
+                changed = False
+                for axiom in axioms_from_layer[layer]:
+                    var, value = axiom.effect
+                    if (values[var] != value) and all(values[v] == val for v, val in axiom.condition):
+                        values[var] = value
+                        changed = True
+        return tuple(values)
+    return fn
+
+def get_preconditions(operator):
+    return list(operator.prevail) + [(var, pre) for var, pre, _, _ in operator.pre_post if pre != -1]
+
+def is_applicable(state, operator):
+    return all(state[var] == value for var, value in get_preconditions(operator))
+
+def apply_operator(state, operator, axiom_fn):
+    values = list(state)
+    for var, _, post, conditions in operator.pre_post:
+        if all(state[v] == val for v, val in conditions):
+            values[var] = post
+    return axiom_fn(values)
+
+def is_goal(sas_task, state):
+    return all(state[var] == value for var, value in sas_task.goal.pairs)
+
+##################################################
+
+def get_unary_operators(sas_task):
+    # Costs are adapted like FastDownward's cost_type=PLUSONE
+    unary_operators = []
+    for index, operator in enumerate(sas_task.operators):
+        preconditions = get_preconditions(operator)
+        cost = get_operator_cost(sas_task, operator) + 1
+        for var, _, post, conditions in operator.pre_post:
+            unary_operators.append(UnaryOperator(index, frozenset(preconditions + list(conditions)),
+                                                 (var, post), cost))
+    for axiom in sas_task.axioms:
+        unary_operators.append(UnaryOperator(None, frozenset(axiom.condition), axiom.effect, 0))
+    return unary_operators
+
+def compute_relaxed(unary_operators, operators_from_fact, facts):
+    # Dijkstra over facts with additive costs (h_add) while recording the best supporters (h_ff)
+    cost_from_fact = {fact: 0 for fact in facts}
+    supporter_from_fact = {}
+    unsatisfied = {i: len(op.conditions) for i, op in enumerate(unary_operators)}
+    counter = count()
+    queue = [(0, next(counter), fact) for fact in facts]
+    for op in unary_operators:
+        if not op.conditions and (op.cost < cost_from_fact.get(op.effect, INF)):
+            cost_from_fact[op.effect] = op.cost
+            supporter_from_fact[op.effect] = op
+            heappush(queue, (op.cost, next(counter), op.effect))
+    processed = set()
+    while queue:
+        cost, _, fact = heappop(queue)
+        if fact in processed:
+            continue
+        processed.add(fact)
+        for i in operators_from_fact[fact]:
+            unsatisfied[i] -= 1
+            if unsatisfied[i] != 0:
+                continue
+            op = unary_operators[i]
+            new_cost = op.cost + sum(cost_from_fact[condition] for condition in op.conditions)
+            if new_cost < cost_from_fact.get(op.effect, INF):
+                cost_from_fact[op.effect] = new_cost
+                supporter_from_fact[op.effect] = op
+                heappush(queue, (new_cost, next(counter), op.effect))
+    return cost_from_fact, supporter_from_fact
+
+def get_heuristic_fn(sas_task, heuristic):
+    # Returns the heuristic value and the preferred operators (indices) of a state
+    goals = list(sas_task.goal.pairs)
+    if heuristic == 'blind':
+        return lambda state: (0 if is_goal(sas_task, state) else 1, set())
+    if heuristic == 'goalcount':
+        return lambda state: (sum(state[var] != value for var, value in goals), set())
+    unary_operators = get_unary_operators(sas_task)
+    operators_from_fact = defaultdict(list)
+    for i, op in enumerate(unary_operators):
+        for condition in op.conditions:
+            operators_from_fact[condition].append(i)
+    # Default values of derived variables are always achievable (negation as failure)
+    default_facts = {(var, sas_task.init.values[var]) for var in get_derived_variables(sas_task)}
+
+    def fn(state):
+        facts = set(enumerate(state)) | default_facts
+        cost_from_fact, supporter_from_fact = compute_relaxed(unary_operators, operators_from_fact, facts)
+        if any(goal not in cost_from_fact for goal in goals):
+            return INF, set()
+        supporters = set()
+        queue = [goal for goal in goals if goal not in facts]
+        while queue:
+            fact = queue.pop()
+            op = supporter_from_fact[fact]
+            if op not in supporters:
+                supporters.add(op)
+                queue.extend(condition for condition in op.conditions if condition not in facts)
+        # Like FastDownward, the applicable operators (not axioms) of the relaxed plan are preferred
+        preferred = {op.index for op in supporters if (op.index is not None) and (op.conditions <= facts)}
+        if heuristic == 'add':
+            return sum(cost_from_fact[goal] for goal in goals), preferred
+        return sum(op.cost for op in supporters), preferred
+    return fn
+
+##################################################
+
+def python_search(sas_task, planner=DEFAULT_PLANNER, max_planner_time=DEFAULT_MAX_TIME,
+                  max_cost=INF, debug=False, plan_fn=None, **kwargs):
+    """
+    Searches the in-memory SAS+ task using the eager search of the FastDownward configuration:
+    uniform-cost search for optimal configurations, (weighted) A* with f = g + w*h,
+    or greedy best-first search, alternating with an open list of preferred successors when used
+    Unlike FastDownward, the heuristic recomputes the entire relaxed exploration for each state,
+    closed states are never reopened (so inconsistent heuristics might return suboptimal plans),
+    and the search holds SOLVE_LOCK throughout (so it does not overlap with sampling in a background search)
+    :return: a tuple (plan, cost) like run_search
+    """
+    start_time = time()
+    config = get_search_config(planner)
+    if config is None:
+        raise ValueError('Planner {} is not supported by the in-process search'.format(planner))
+    heuristic_fn = get_heuristic_fn(sas_task, config.heuristic)
+    bound = scale_cost(max_cost) # Exclusive like FastDownward's bound
+    axiom_fn = get_axiom_fn(sas_task)
+    initial = axiom_fn(list(sas_task.init.values))
+
+    def evaluate(state):
+        if config.weight == 0:
+            return 0, set()
+        return heuristic_fn(state)
+
+    def get_priority(h, adapted_cost):
+        if config.weight is None:
+            return (h, adapted_cost)
+        return (adapted_cost + config.weight*h, h)
+
+    counter = count()
+    parent_from_state = {initial: (None, None, 0, 0)} # (parent, operator, cost, adapted cost)
+    h, preferred = evaluate(initial)
+    preferred_from_state = {initial: preferred}
+    queues = [[] for _ in range(1 + config.preferred)] # All successors and the preferred successors
+    heappush(queues[0], (get_priority(h, 0), next(counter), initial))
+    turn = 0
+    closed = set()
+    num_expanded = 0
+    goal_state = None
+    while any(queues):
+        if (num_expanded % TIME_PERIOD == 0) and (max_planner_time <= elapsed_time(start_time)):
+            break
+        # Alternates between the non-empty open lists like FastDownward's alt
+        turn = (turn + 1) % len(queues)
+        queue = queues[turn] if queues[turn] else [q for q in queues if q][0]
+        _, _, state = heappop(queue)
+        if state in closed:
+            continue
+        closed.add(state)
+        num_expanded += 1
+        if is_goal(sas_task, state):
+            goal_state = state
+            break
+        _, _, cost, adapted_cost = parent_from_state[state]
+        preferred = preferred_from_state.pop(state)
+        for index, operator in enumerate(sas_task.operators):
+            if not is_applicable(state, operator):
+                continue
+            new_cost = cost + get_operator_cost(sas_task, operator)
+            if bound <= new_cost:
+                continue
+            new_adapted_cost = adapted_cost + get_operator_cost(sas_task, operator) + 1
+            new_state = apply_operator(state, operator, axiom_fn)
+            if (new_state in closed) or (new_state in parent_from_state and
+                                         ((config.weight is None) or
+                                          (parent_from_state[new_state][3] <= new_adapted_cost))):
+                continue
+            h, new_preferred = evaluate(new_state)
+            if h == INF:
+                continue
+            parent_from_state[new_state] = (state, operator, new_cost, new_adapted_cost)
+            preferred_from_state[new_state] = new_preferred
+            element = (get_priority(h, new_adapted_cost), next(counter), new_state)
+            heappush(queues[0], element)
+            if config.preferred and (index in preferred):
+                heappush(queues[1], element)
+
+    if debug:
+        print('Python search ({}, {}) | Expanded: {} | Generated: {} | Runtime: {:.3f}'.format(
+            planner, config.heuristic, num_expanded, len(parent_from_state), elapsed_time(start_time)))
+    if goal_state is None:
+        return None, INF
+    sas_plan = []
+    state = goal_state
+    while parent_from_state[state][0] is not None:
+        state, operator, _, _ = parent_from_state[state]
+        sas_plan.append(operator)
+    plan = [parse_action(operator.name) for operator in reversed(sas_plan)]
+    cost = parent_from_state[goal_state][2] / get_cost_scale()
+    if plan_fn is not None:
+        plan_fn(plan, cost)
+    return plan, cost
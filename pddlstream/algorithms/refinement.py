@@ -7,7 +7,7 @@ from copy import deepcopy, copy
 
 from pddlstream.algorithms.instantiation import Instantiator
 from pddlstream.algorithms.scheduling.plan_streams import plan_streams, OptSolution
-from pddlstream.algorithms.scheduling.recover_streams import evaluations_from_stream_plan
+from pddlstream.algorithms.scheduling.recover_streams import evaluations_from_stream_plan, AchievingStreams
 from pddlstream.algorithms.constraints import add_plan_constraints, PlanConstraints, WILD
 from pddlstream.language.constants import FAILED, INFEASIBLE, is_plan
 from pddlstream.language.conversion import evaluation_from_fact, substitute_expression
@@ -135,12 +135,15 @@ def compute_skeleton_constraints(opt_plan, bindings):
     # exact=False because we might need new actions
     return PlanConstraints(skeletons=[skeleton], groups=groups, exact=False, max_cost=INF)
 
-def get_optimistic_solve_fn(goal_exp, domain, negative, max_cost=INF, **kwargs):
+def get_optimistic_solve_fn(goal_exp, domain, negative, max_cost=INF, alternatives=None, **kwargs):
     # TODO: apply to hierarchical actions representations (will need to instantiate more actions)
+    achieving_fn = AchievingStreams() # Shared across iterations
     def fn(evaluations, results, constraints):
+        if alternatives is not None:
+            del alternatives[:] # Only keep the alternatives from the latest grounding
         if constraints is None:
             return plan_streams(evaluations, goal_exp, domain, results, negative,
-                                max_cost=max_cost, **kwargs)
+                                max_cost=max_cost, alternatives=alternatives, achieving_fn=achieving_fn, **kwargs)
         #print(*relaxed_stream_plan(evaluations, goal_exp, domain, results, negative,
         #                               max_cost=max_cost, **kwargs))
         #constraints.dump()
@@ -149,7 +152,7 @@ def get_optimistic_solve_fn(goal_exp, domain, negative, max_cost=INF, **kwargs):
         goal_exp2 = add_plan_constraints(constraints, domain2, evaluations2, goal_exp, internal=True)
         max_cost2 = max_cost if (constraints is None) else min(max_cost, constraints.max_cost)
         return plan_streams(evaluations2, goal_exp2, domain2, results, negative,
-                            max_cost=max_cost2, **kwargs)
+                            max_cost=max_cost2, achieving_fn=achieving_fn, **kwargs)
     return fn
 
 ##################################################
@@ -190,12 +193,23 @@ def hierarchical_plan_streams(evaluations, externals, results, optimistic_solve_
     return hierarchical_plan_streams(evaluations, externals, next_results, optimistic_solve_fn, complexity_limit,
                                      new_depth, next_constraints, **effort_args)
 
-def iterative_plan_streams(all_evaluations, externals, optimistic_solve_fn, complexity_limit, **effort_args):
+def get_search_fingerprint(all_evaluations, externals, complexity_limit, *args):
+    # Identical fingerprints yield identical results from iterative_plan_streams (when ignoring stream effort)
+    complexity_evals = frozenset((e, n.complexity) for e, n in all_evaluations.items()
+                                 if n.complexity <= complexity_limit)
+    instance_states = frozenset((instance, instance.opt_index, instance.enumerated, instance.disabled)
+                                for external in externals for instance in external.instances.values())
+    return (complexity_limit, complexity_evals, instance_states) + tuple(args)
+
+def iterative_plan_streams(all_evaluations, externals, optimistic_solve_fn, complexity_limit, deadline=None,
+                           **effort_args):
     # Previously didn't have unique optimistic objects that could be constructed at arbitrary depths
     start_time = time.time()
     complexity_evals = {e: n for e, n in all_evaluations.items() if n.complexity <= complexity_limit}
     num_iterations = 0
     while True:
+        if (deadline is not None) and (deadline.remaining_search_time() <= 0):
+            return OptSolution(FAILED, FAILED, INF)
         num_iterations += 1
         results, exhausted = optimistic_process_streams(complexity_evals, externals, complexity_limit, **effort_args)
         opt_solution, final_depth = hierarchical_plan_streams(
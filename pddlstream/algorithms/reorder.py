@@ -1,6 +1,6 @@
 import time
 
-from collections import namedtuple, deque, Counter
+from collections import namedtuple, Counter
 from itertools import combinations
 
 from pddlstream.language.constants import is_plan
@@ -8,7 +8,10 @@ from pddlstream.language.external import Result
 from pddlstream.language.statistics import Stats, Performance, EPSILON
 from pddlstream.language.stream import StreamResult
 from pddlstream.utils import INF, neighbors_from_orders, topological_sort, get_connected_components, \
-    sample_topological_sort, is_acyclic, layer_sort, Score, safe_zip
+    sample_topological_sort, is_acyclic, layer_sort, Score, safe_zip, elapsed_time
+
+MAX_REORDER_WIDTH = 1000 # Maximum number of subsets per layer in dynamic_programming (INF is exact)
+MAX_REORDER_TIME = 5 # Maximum time in seconds before falling back to greedy_reorder_stream_plan
 
 
 def get_output_objects(result):
@@ -101,7 +104,14 @@ def compute_pruning_orders(results, stats_fn=Performance.get_statistics, tiebrea
             effort_orders.add((v2, v1))
     return effort_orders
 
-def dynamic_programming(store, vertices, valid_head_fn, stats_fn=Performance.get_statistics, prune=True, greedy=False, **kwargs):
+def dynamic_programming(store, vertices, valid_head_fn, stats_fn=Performance.get_statistics, prune=True, greedy=False,
+                        max_width=INF, max_time=INF, pruned=None, **kwargs):
+    """
+    Backward dynamic programming over subsets of the stream DAG that is bounded to max_width subsets per layer
+    (beam search) and to max_time seconds. Subsets are always extendable, so the beam never dead-ends.
+    :param pruned: an optional list that is extended with the subsets discarded by the beam
+    :return: an ordering of vertices or None if max_time was exceeded
+    """
     # TODO: include context here as a weak constraint
     # TODO: works in the absence of partial orders
     # TODO: can also more manually reorder
@@ -115,34 +125,46 @@ def dynamic_programming(store, vertices, valid_head_fn, stats_fn=Performance.get
     # TODO: can break ties with index on action plan to prioritize doing the temporally first things
 
     # TODO: could the greedy strategy lead to premature choices
-    # TODO: this starts to blow up - group together similar streams (e.g. collision streams) to decrease size
+    # TODO: group together similar streams (e.g. collision streams) to decrease size
     # TODO: key grouping concern are partial orders and ensuring feasibility (isomorphism)
     # TODO: flood-fill cheapest as soon as something that has no future dependencies has been found
     # TODO: do the forward version to take advantage of sink vertices
     subset = frozenset()
-    queue = deque([subset]) # Acyclic because subsets
+    layer = [subset] # Acyclic because subsets
     subproblems = {subset: Subproblem(cost=0, head=None, subset=None)}
-    while queue: # searches backward from last to first
-        if store.is_terminated():
-            return vertices
-        subset = queue.popleft() # TODO: greedy/weighted A* version of this (heuristic is next cheapest stream)
-        applied = set()
-        # TODO: roll-out more than one step to cut the horizon
-        # TODO: compute a heuristic that's the best case affordances from subsequent streams
-        for v in priority_ordering: # most expensive first
-            if greedy and applied:
-                break
-            if (v not in subset) and valid_head_fn(v, subset) and not (out_priority_orders[v] & applied):
-                applied.add(v)
-                new_subset = frozenset([v]) | subset
-                p_success, overhead = stats_fn(v)
-                new_cost = overhead + p_success*subproblems[subset].cost
-                subproblem = Subproblem(cost=new_cost, head=v, subset=subset)  # Adds new element to the front
-                if new_subset not in subproblems:
-                    queue.append(new_subset)
-                    subproblems[new_subset] = subproblem
-                elif new_cost < subproblems[new_subset].cost:
-                    subproblems[new_subset] = subproblem
+    while layer: # searches backward from last to first
+        new_layer = []
+        for subset in layer:
+            if store.is_terminated():
+                return vertices
+            if max_time <= elapsed_time(start_time):
+                return None
+            applied = set()
+            # TODO: roll-out more than one step to cut the horizon
+            # TODO: compute a heuristic that's the best case affordances from subsequent streams
+            for v in priority_ordering: # most expensive first
+                if greedy and applied:
+                    break
+                if (v not in subset) and valid_head_fn(v, subset) and not (out_priority_orders[v] & applied):
+                    applied.add(v)
+                    new_subset = frozenset([v]) | subset
+                    p_success, overhead = stats_fn(v)
+                    new_cost = overhead + p_success*subproblems[subset].cost
+                    subproblem = Subproblem(cost=new_cost, head=v, subset=subset)  # Adds new element to the front
+                    if new_subset not in subproblems:
+                        new_layer.append(new_subset)
+                        subproblems[new_subset] = subproblem
+                    elif new_cost < subproblems[new_subset].cost:
+                        subproblems[new_subset] = subproblem
+        if max_width < len(new_layer):
+            # Subsets within a layer have the same size, so their suffix costs are comparable
+            new_layer.sort(key=lambda s: subproblems[s].cost)
+            for new_subset in new_layer[max_width:]:
+                del subproblems[new_subset]
+            if pruned is not None:
+                pruned.extend(new_layer[max_width:])
+            new_layer = new_layer[:max_width]
+        layer = new_layer
 
     ordering = []
     subset = frozenset(vertices)
@@ -261,10 +283,26 @@ def optimal_reorder_stream_plan(store, stream_plan, stats_from_stream=None, **kw
     #tiebreaker_fn = lambda *args: 0
     #tiebreaker_fn = lambda *args: random.random() # TODO: introduces cycles
     tiebreaker_fn = lambda idx: stream_plan[idx].stats_heuristic()
-    ordering = dynamic_programming(store, nodes, valid_combine, stats_fn=stats_fn, tiebreaker_fn=tiebreaker_fn, **kwargs)
+    pruned = []
+    ordering = dynamic_programming(store, nodes, valid_combine, stats_fn=stats_fn, tiebreaker_fn=tiebreaker_fn,
+                                   max_width=MAX_REORDER_WIDTH, max_time=MAX_REORDER_TIME, pruned=pruned, **kwargs)
     #import gc
     #gc.collect()
-    return [stream_plan[index] for index in ordering]
+    if (ordering is not None) and not pruned:
+        return [stream_plan[index] for index in ordering] # Optimal with respect to the stats
+    # Falls back to the greedy ordering when the bounded search timed out or is worse
+    stats_fn = lambda s: stats_from_stream[s]
+    candidates = [greedy_reorder_stream_plan(stream_plan)]
+    if ordering is not None:
+        candidates.insert(0, [stream_plan[index] for index in ordering])
+    best_plan = min(candidates, key=lambda p: compute_expected_cost(p, stats_fn=stats_fn))
+    best_cost = compute_expected_cost(best_plan, stats_fn=stats_fn)
+    gaps = [compute_expected_cost(p, stats_fn=stats_fn) - best_cost for p in candidates]
+    print('Bounded reordering | Streams: {} | Pruned: {} | Timeout: {} | '
+          'Expected cost: {:.3f} | Gap: {}'.format(
+        len(stream_plan), len(pruned), ordering is None, best_cost,
+        ' '.join('{}={:.3f}'.format(name, gap) for name, gap in zip(['beam', 'greedy'][-len(gaps):], gaps))))
+    return best_plan
 
 ##################################################
 
@@ -1,6 +1,6 @@
 from pddlstream.algorithms.downward import fd_from_fact, fact_from_fd
 from pddlstream.algorithms.scheduling.negative import get_negative_result
-from pddlstream.algorithms.scheduling.recover_streams import extract_stream_plan
+from pddlstream.algorithms.scheduling.recover_streams import extract_stream_plan, get_plan_from_fact
 from pddlstream.algorithms.scheduling.utils import get_instance_facts
 from pddlstream.language.optimizer import ComponentStream
 from pddlstream.language.constants import get_args, get_prefix
@@ -23,7 +23,7 @@ def add_optimizer_effects(instantiated, node_from_atom):
                     raise NotImplementedError(literal)
         facts = get_instance_facts(instance, node_from_atom)
         stream_plan = []
-        extract_stream_plan(node_from_atom, facts, stream_plan)
+        extract_stream_plan(node_from_atom, facts, stream_plan, get_plan_from_fact(node_from_atom))
         # TODO: can detect if some of these are simultaneous and add them as preconditions
         for result in stream_plan:
             #if isinstance(result.external, ComponentStream):
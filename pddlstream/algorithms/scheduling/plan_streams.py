@@ -16,11 +16,11 @@ from pddlstream.algorithms.scheduling.postprocess import postprocess_stream_plan
 from pddlstream.algorithms.scheduling.recover_axioms import recover_axioms_plans
 from pddlstream.algorithms.scheduling.recover_functions import compute_function_plan
 from pddlstream.algorithms.scheduling.recover_streams import get_achieving_streams, extract_stream_plan, \
-    evaluations_from_stream_plan
+    evaluations_from_stream_plan, get_plan_from_fact
 from pddlstream.algorithms.scheduling.stream_action import add_stream_actions
 from pddlstream.algorithms.scheduling.utils import partition_results, \
     add_unsatisfiable_to_goal, get_instance_facts
-from pddlstream.algorithms.search import solve_from_task
+from pddlstream.algorithms.search import solve_from_task, solve_diverse_from_task
 from pddlstream.algorithms.advanced import UNIVERSAL_TO_CONDITIONAL
 from pddlstream.language.constants import Not, get_prefix, EQ, FAILED, OptPlan, Action
 from pddlstream.language.conversion import obj_from_pddl_plan, evaluation_from_fact, \
@@ -30,7 +30,6 @@ from pddlstream.language.exogenous import get_fluent_domain
 from pddlstream.language.function import Function
 from pddlstream.language.stream import StreamResult
 from pddlstream.language.optimizer import UNSATISFIABLE
-from pddlstream.language.statistics import compute_plan_effort
 from pddlstream.language.temporal import SimplifiedDomain, solve_tfd
 from pddlstream.language.write_pddl import get_problem_pddl
 from pddlstream.language.object import Object
@@ -50,14 +49,19 @@ def add_stream_efforts(node_from_atom, instantiated, effort_weight, **kwargs):
     # TODO: make effort just a multiplier (or relative) to avoid worrying about the scale
     # TODO: regularize & normalize across the problem?
     #efforts = []
+    plan_from_fact = get_plan_from_fact(node_from_atom)
+    effort_from_result = {}
     for instance in instantiated.actions:
         # TODO: prune stream actions here?
         # TODO: round each effort individually to penalize multiple streams
         facts = get_instance_facts(instance, node_from_atom)
         #effort = COMBINE_OP([0] + [node_from_atom[fact].effort for fact in facts])
         stream_plan = []
-        extract_stream_plan(node_from_atom, facts, stream_plan)
-        effort = compute_plan_effort(stream_plan, **kwargs)
+        extract_stream_plan(node_from_atom, facts, stream_plan, plan_from_fact)
+        for result in stream_plan:
+            if result not in effort_from_result:
+                effort_from_result[result] = result.get_effort(**kwargs)
+        effort = sum(effort_from_result[result] for result in stream_plan) # Same as compute_plan_effort
         instance.cost += scale_cost(effort_weight*effort)
         # TODO: store whether it uses shared/unique outputs and prune too expensive streams
         #efforts.append(effort)
@@ -265,9 +269,11 @@ def recover_stream_plan(evaluations, current_plan, opt_evaluations, goal_express
 
 def solve_optimistic_temporal(domain, stream_domain, applied_results, all_results,
                               opt_evaluations, node_from_atom, goal_expression,
-                              effort_weight, debug=False, **kwargs):
+                              effort_weight, num_plans=1, other_plans=None, debug=False, **kwargs):
     # TODO: assert that the unused parameters are off
     assert domain is stream_domain
+    if num_plans != 1:
+        print('Warning! TFD returns a single plan per search (num_plans={})'.format(num_plans))
     #assert len(applied_results) == len(all_results)
     problem = get_problem(opt_evaluations, goal_expression, domain)
     with Verbose():
@@ -296,12 +302,12 @@ def solve_optimistic_temporal(domain, stream_domain, applied_results, all_result
 
 def solve_optimistic_sequential(domain, stream_domain, applied_results, all_results,
                                 opt_evaluations, node_from_atom, goal_expression,
-                                effort_weight, debug=False, **kwargs):
+                                effort_weight, num_plans=1, other_plans=None, debug=False, **kwargs):
     #print(sorted(map(fact_from_evaluation, opt_evaluations)))
     temporal_plan = None
     problem = get_problem(opt_evaluations, goal_expression, stream_domain)  # begin_metric
     with Verbose(verbose=debug):
-        task = task_from_domain_problem(stream_domain, problem)
+        task = task_from_domain_problem(stream_domain, problem, prune=True, verbose=debug)
         instantiated = instantiate_task(task)
     if instantiated is None:
         return instantiated, None, temporal_plan, INF
@@ -315,25 +321,66 @@ def solve_optimistic_sequential(domain, stream_domain, applied_results, all_resu
     action_from_name = rename_instantiated_actions(instantiated, RENAME_ACTIONS)
     # TODO: the action unsatisfiable conditions are pruned
     with Verbose(debug):
-        sas_task = sas_from_instantiated(instantiated)
-        #sas_task.metric = task.use_min_cost_metric
-        sas_task.metric = True
+        #sas_task = sas_from_instantiated(instantiated, metric=task.use_min_cost_metric)
+        sas_task = sas_from_instantiated(instantiated, metric=True, verbose=debug)
 
     # TODO: apply renaming to hierarchy as well
     # solve_from_task | serialized_solve_from_task | abstrips_solve_from_task | abstrips_solve_from_task_sequential
-    renamed_plan, _ = solve_from_task(sas_task, debug=debug, **kwargs)
-    if renamed_plan is None:
+    if num_plans == 1:
+        # Anytime searches also report their intermediate plans, which are kept as alternatives
+        intermediate_plans = []
+        plan, cost = solve_from_task(sas_task, debug=debug, plan_fn=lambda *args: intermediate_plans.append(args),
+                                     **kwargs)
+        renamed_plans = [(plan, cost)] + [(other_plan, other_cost) for other_plan, other_cost
+                                          in reversed(intermediate_plans) if other_plan != plan]
+    else:
+        renamed_plans = solve_diverse_from_task(sas_task, num_plans=num_plans, debug=debug, **kwargs)
+    renamed_plans = [plan for plan, _ in renamed_plans if plan is not None]
+    if not renamed_plans:
         return instantiated, None, temporal_plan, INF
 
-    action_instances = [action_from_name[name if RENAME_ACTIONS else '({} {})'.format(name, ' '.join(args))]
-                        for name, args in renamed_plan]
+    action_plans = [[action_from_name[name if RENAME_ACTIONS else '({} {})'.format(name, ' '.join(args))]
+                     for name, args in renamed_plan] for renamed_plan in renamed_plans]
+    if other_plans is not None:
+        other_plans.extend((action_instances, get_plan_cost(action_instances, cost_from_action))
+                           for action_instances in action_plans[1:])
+    action_instances = action_plans[0]
     cost = get_plan_cost(action_instances, cost_from_action)
     return instantiated, action_instances, temporal_plan, cost
 
 ##################################################
 
+def recover_opt_solution(evaluations, goal_expression, stream_domain, instantiated, action_instances, cost,
+                         applied_results, negative, deferred_from_name, opt_evaluations, node_from_atom,
+                         replan_actions=set(), temporal_plan=None):
+    action_instances, axiom_plans = recover_axioms_plans(instantiated, action_instances)
+    # TODO: extract out the minimum set of conditional effects that are actually required
+    #simplify_conditional_effects(instantiated.task, action_instances)
+    stream_plan, action_instances = recover_simultaneous(
+        applied_results, negative, deferred_from_name, action_instances)
+
+    action_plan = transform_plan_args(map(pddl_from_instance, action_instances), obj_from_pddl)
+    replan_step = min([step+1 for step, action in enumerate(action_plan)
+                       if action.name in replan_actions] or [len(action_plan)+1]) # step after action application
+
+    stream_plan, opt_plan = recover_stream_plan(evaluations, stream_plan, opt_evaluations, goal_expression, stream_domain,
+        node_from_atom, action_instances, axiom_plans, negative, replan_step)
+    if temporal_plan is not None:
+        # TODO: handle deferred streams
+        assert all(isinstance(action, Action) for action in opt_plan.action_plan)
+        opt_plan.action_plan[:] = temporal_plan
+    return OptSolution(stream_plan, opt_plan, cost)
+
 def plan_streams(evaluations, goal_expression, domain, all_results, negative, effort_weight, max_effort,
-                 simultaneous=False, reachieve=True, replan_actions=set(), **kwargs):
+                 simultaneous=False, reachieve=True, replan_actions=set(), alternatives=None,
+                 achieving_fn=get_achieving_streams, **kwargs):
+    """
+    Solves the optimistic planning problem and recovers the stream plan that supports the action plan
+    :param alternatives: If not None, a list that is extended with the OptSolutions of the remaining plans
+        when also passing num_plans > 1 for the search
+    :param achieving_fn: get_achieving_streams or an AchievingStreams that persists across calls
+    :return: the OptSolution of the best plan
+    """
     # TODO: alternatively could translate with stream actions on real opt_state and just discard them
     # TODO: only consider axioms that have stream conditions?
     #reachieve = reachieve and not using_optimizers(all_results)
@@ -350,34 +397,26 @@ def plan_streams(evaluations, goal_expression, domain, all_results, negative, ef
         evaluations = init_evaluations # For clarity
 
     # TODO: could iteratively increase max_effort
-    node_from_atom = get_achieving_streams(evaluations, applied_results, # TODO: apply to all_results?
-                                           max_effort=max_effort)
+    node_from_atom = achieving_fn(evaluations, applied_results, # TODO: apply to all_results?
+                                  max_effort=max_effort)
     opt_evaluations = {evaluation_from_fact(f): n.result for f, n in node_from_atom.items()}
     if UNIVERSAL_TO_CONDITIONAL or using_optimizers(all_results):
         goal_expression = add_unsatisfiable_to_goal(stream_domain, goal_expression)
 
     temporal = isinstance(stream_domain, SimplifiedDomain)
     optimistic_fn = solve_optimistic_temporal if temporal else solve_optimistic_sequential
+    other_plans = []
     instantiated, action_instances, temporal_plan, cost = optimistic_fn(
         domain, stream_domain, applied_results, all_results, opt_evaluations,
-        node_from_atom, goal_expression, effort_weight, **kwargs)
+        node_from_atom, goal_expression, effort_weight, other_plans=other_plans, **kwargs)
     if action_instances is None:
         return OptSolution(FAILED, FAILED, cost)
 
-    action_instances, axiom_plans = recover_axioms_plans(instantiated, action_instances)
-    # TODO: extract out the minimum set of conditional effects that are actually required
-    #simplify_conditional_effects(instantiated.task, action_instances)
-    stream_plan, action_instances = recover_simultaneous(
-        applied_results, negative, deferred_from_name, action_instances)
-
-    action_plan = transform_plan_args(map(pddl_from_instance, action_instances), obj_from_pddl)
-    replan_step = min([step+1 for step, action in enumerate(action_plan)
-                       if action.name in replan_actions] or [len(action_plan)+1]) # step after action application
-
-    stream_plan, opt_plan = recover_stream_plan(evaluations, stream_plan, opt_evaluations, goal_expression, stream_domain,
-        node_from_atom, action_instances, axiom_plans, negative, replan_step)
-    if temporal_plan is not None:
-        # TODO: handle deferred streams
-        assert all(isinstance(action, Action) for action in opt_plan.action_plan)
-        opt_plan.action_plan[:] = temporal_plan
-    return OptSolution(stream_plan, opt_plan, cost)
+    recover_args = (applied_results, negative, deferred_from_name, opt_evaluations, node_from_atom, replan_actions)
+    if alternatives is not None:
+        # All plans share a single grounding and thus the same optimistic evaluations
+        alternatives.extend(recover_opt_solution(evaluations, goal_expression, stream_domain, instantiated,
+                                                 other_instances, other_cost, *recover_args)
+                            for other_instances, other_cost in other_plans)
+    return recover_opt_solution(evaluations, goal_expression, stream_domain, instantiated, action_instances, cost,
+                                *recover_args, temporal_plan=temporal_plan)
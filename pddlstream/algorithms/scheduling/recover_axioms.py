@@ -1,14 +1,19 @@
 from collections import defaultdict
+from weakref import WeakKeyDictionary
 
 from pddlstream.algorithms.downward import get_literals, apply_action, \
-    get_derived_predicates, literal_holds, GOAL_NAME, get_precondition
-from pddlstream.algorithms.instantiate_task import get_goal_instance, filter_negated, get_achieving_axioms
+    get_derived_predicates, literal_holds, GOAL_NAME, LazyModule
+from pddlstream.algorithms.instantiate_task import get_goal_instance, filter_negated, get_achieving_axioms, \
+    copy_instance
 from pddlstream.language.constants import is_parameter
-from pddlstream.utils import Verbose, MockSet, safe_zip, flatten
+from pddlstream.utils import Verbose, MockSet, safe_zip
 
 import copy
-import pddl
-import axiom_rules
+
+pddl = LazyModule('pddl')
+axiom_rules = LazyModule('axiom_rules')
+
+AXIOM_MODEL_FROM_TASK = WeakKeyDictionary() # Alternative plans share the instantiated task
 
 
 def get_necessary_axioms(conditions, axioms, negative_from_name):
@@ -177,31 +182,90 @@ def backtrack_axioms(conditions, axioms_from_effect, visited_atoms):
             visited_axioms.extend(backtrack_axioms(axiom.condition, axioms_from_effect, visited_atoms))
     return visited_axioms
 
+class AxiomModel(object):
+    """
+    Maintains the derived atoms of get_achieving_axioms (and their achieving axioms) along a plan
+    Applying an action invalidates the atoms whose (transitive) achievers are conditioned on changed atoms,
+    which are then rederived along with the atoms enabled by the changed atoms
+    """
+    def __init__(self, axioms, init):
+        self.axioms = axioms
+        self.init = frozenset(init)
+        self.axioms_from_effect = defaultdict(list)
+        self.axioms_from_condition = defaultdict(list) # Indexed by the atom of each condition
+        for axiom in axioms:
+            self.axioms_from_effect[axiom.effect].append(axiom)
+            for literal in axiom.condition:
+                self.axioms_from_condition[literal.positive()].append(axiom)
+        self.state = set(self.init)
+        axiom_from_literal, _ = get_achieving_axioms(self.state, axioms)
+        self.axiom_from_atom = {literal: axiom for literal, axiom in axiom_from_literal.items()
+                                if axiom is not None}
+    def copy(self):
+        # Shares the axiom indices with the cached model
+        new_model = copy.copy(self)
+        new_model.state = set(self.state)
+        new_model.axiom_from_atom = dict(self.axiom_from_atom)
+        return new_model
+    def holds(self, literal):
+        return literal_holds(self.state, literal) or (literal in self.axiom_from_atom)
+    def _derive(self, axiom, queue):
+        if (axiom.effect not in self.axiom_from_atom) and all(map(self.holds, axiom.condition)):
+            self.axiom_from_atom[axiom.effect] = axiom
+            queue.append(axiom.effect)
+    def _invalidate(self, changed_atoms):
+        queue = list(changed_atoms)
+        invalid_atoms = set()
+        while queue:
+            atom = queue.pop()
+            for axiom in self.axioms_from_condition[atom]:
+                effect = axiom.effect
+                if (effect not in invalid_atoms) and (self.axiom_from_atom.get(effect) is axiom):
+                    invalid_atoms.add(effect)
+                    del self.axiom_from_atom[effect]
+                    queue.append(effect.positive())
+        return invalid_atoms
+    def apply(self, action):
+        effects = {effect for _, effect in action.add_effects + action.del_effects}
+        previous_atoms = {atom for atom in effects if atom in self.state}
+        apply_action(self.state, action)
+        changed_atoms = {atom for atom in effects if (atom in previous_atoms) != (atom in self.state)}
+        invalid_atoms = self._invalidate(changed_atoms)
+        queue = []
+        for atom in changed_atoms:
+            for axiom in self.axioms_from_condition[atom]:
+                self._derive(axiom, queue)
+        for atom in invalid_atoms:
+            for axiom in self.axioms_from_effect[atom]:
+                self._derive(axiom, queue)
+        while queue:
+            atom = queue.pop()
+            for axiom in self.axioms_from_condition[atom.positive()]:
+                self._derive(axiom, queue)
+
+def get_axiom_model(instantiated):
+    task = instantiated.task
+    model = AXIOM_MODEL_FROM_TASK.get(task, None)
+    if (model is None) or (model.axioms is not instantiated.axioms) or (model.init != set(task.init)):
+        model = AxiomModel(instantiated.axioms, task.init)
+        AXIOM_MODEL_FROM_TASK[task] = model
+    return model.copy()
+
 def recover_axioms_plans(instantiated, action_instances):
     #axioms, axiom_init, _ = axiom_rules.handle_axioms(
     #    instantiated.actions, instantiated.axioms, instantiated.goal_list)
 
-    new_action_instances = [copy.deepcopy(instance) for instance in action_instances]
-
-    axioms, axiom_init = instantiated.axioms, [] # TODO: bug when needing to reachieve negated
-    axioms_from_effect = defaultdict(list)
-    for axiom in axioms:
-        axioms_from_effect[axiom.effect].append(axiom)
+    new_action_instances = list(map(copy_instance, action_instances))
+    model = get_axiom_model(instantiated) # TODO: bug when needing to reachieve negated
     axioms_from_name = get_derived_predicates(instantiated.task.axioms)
 
-    state = set(instantiated.task.init) | set(axiom_init)
     axiom_plans = []
     for action in new_action_instances + [get_goal_instance(instantiated.task.goal)]:
-        all_conditions = list(get_precondition(action)) + list(flatten(
-            cond for cond, _ in action.add_effects + action.del_effects))
-        axioms = backtrack_axioms(all_conditions, axioms_from_effect, set())
-        axiom_from_atom, _ = get_achieving_axioms(state, axioms)
-
         action.applied_effects = []
         for effects in [action.add_effects, action.del_effects]:
             negate = (effects is action.del_effects)
             for i, (conditions, effect) in reversed(list(enumerate(effects))):
-                if all(literal_holds(state, literal) or (literal in axiom_from_atom) for literal in conditions):
+                if all(map(model.holds, conditions)):
                     action.precondition.extend(conditions)
                     effects[i] = ([], effect)
                     action.applied_effects.append(effect.negate() if negate else effect)
@@ -212,11 +276,10 @@ def recover_axioms_plans(instantiated, action_instances):
         #precondition = action.precondition # TODO: strange bug if this applies
         precondition = [literal for literal in action.precondition if literal.predicate in axioms_from_name]
         axiom_plans.append([])
-        success = extract_axioms(state, axiom_from_atom, precondition, axiom_plans[-1])
+        success = extract_axioms(model.state, model.axiom_from_atom, precondition, axiom_plans[-1])
         if not success:
-            print(all_conditions)
+            print(precondition)
             print(action)
-            print(axioms)
             raise RuntimeError('Could not extract axioms')
-        apply_action(state, action)
+        model.apply(action)
     return new_action_instances, axiom_plans
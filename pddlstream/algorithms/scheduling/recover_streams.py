@@ -45,6 +45,117 @@ def get_achieving_streams(evaluations, stream_results, max_effort=INF, **effort_
     del node_from_atom[NULL_COND]
     return node_from_atom
 
+def get_result_key(result):
+    # Results are recreated every iteration, but their instances and certified facts persist
+    return (result.instance, result.optimistic, tuple(result.get_certified()))
+
+class AchievingStreams(object):
+    """
+    Maintains the node_from_atom of get_achieving_streams across calls
+    Stream results that were removed or whose effort increased (e.g. due to num_calls) invalidate the atoms they
+    (transitively) achieve, which are then recomputed along with the atoms improved by new results and initial atoms
+    Ties between achievers of equal effort might be broken differently than in get_achieving_streams
+    """
+    def __init__(self):
+        self.max_effort = None
+        self.effort_args = None
+        self.reset()
+    def reset(self):
+        self.init_atoms = set()
+        self.effort_from_key = {}
+        self.conditions_from_key = {}
+        self.certified_from_key = {}
+        self.keys_from_condition = defaultdict(set)
+        self.keys_from_certified = defaultdict(set)
+        self.node_from_atom = {} # Node.result is the key of the achieving result
+    def _add_key(self, key, result, effort):
+        self.effort_from_key[key] = effort
+        self.conditions_from_key[key] = result.instance.get_domain()
+        self.certified_from_key[key] = result.get_certified()
+        for atom in self.conditions_from_key[key]:
+            self.keys_from_condition[atom].add(key)
+        for atom in self.certified_from_key[key]:
+            self.keys_from_certified[atom].add(key)
+    def _remove_key(self, key):
+        for atom in self.conditions_from_key[key]:
+            self.keys_from_condition[atom].discard(key)
+        for atom in self.certified_from_key[key]:
+            self.keys_from_certified[atom].discard(key)
+        del self.effort_from_key[key]
+        del self.conditions_from_key[key]
+        del self.certified_from_key[key]
+    def _invalidate(self, invalid_keys, removed_atoms):
+        # Removes every atom whose (transitive) achiever is no longer available at the same effort
+        queue = [atom for atom in removed_atoms if atom in self.node_from_atom]
+        for key in invalid_keys:
+            queue.extend(atom for atom in self.certified_from_key[key]
+                         if (atom in self.node_from_atom) and (self.node_from_atom[atom].result == key))
+        invalid_atoms = set()
+        while queue:
+            atom = queue.pop()
+            if atom in invalid_atoms:
+                continue
+            invalid_atoms.add(atom)
+            del self.node_from_atom[atom]
+            for key in self.keys_from_condition[atom]:
+                queue.extend(new_atom for new_atom in self.certified_from_key[key]
+                             if (new_atom in self.node_from_atom) and (self.node_from_atom[new_atom].result == key))
+        return invalid_atoms
+    def _apply(self, key, queue):
+        if not all(atom in self.node_from_atom for atom in self.conditions_from_key[key]):
+            return
+        total_effort = self.effort_from_key[key] + EFFORT_OP(
+            self.node_from_atom[cond].effort for cond in self.conditions_from_key[key])
+        if (self.max_effort is not None) and (self.max_effort <= total_effort):
+            return
+        for new_atom in self.certified_from_key[key]:
+            if (new_atom not in self.node_from_atom) or (total_effort < self.node_from_atom[new_atom].effort):
+                self.node_from_atom[new_atom] = Node(total_effort, key)
+                heappush(queue, HeapElement(total_effort, new_atom))
+    def __call__(self, evaluations, stream_results, max_effort=INF, **effort_args):
+        if (max_effort != self.max_effort) or (effort_args != self.effort_args):
+            self.reset()
+            self.max_effort = max_effort
+            self.effort_args = effort_args
+        init_atoms = {fact_from_evaluation(e) for e in evaluations if not is_negated_atom(e)}
+        result_from_key = {}
+        effort_from_key = {}
+        for result in stream_results:
+            key = get_result_key(result)
+            if key not in result_from_key:
+                result_from_key[key] = result
+                effort_from_key[key] = result.get_effort(**effort_args)
+        invalid_keys = {key for key, effort in self.effort_from_key.items()
+                        if (key not in effort_from_key) or (effort < effort_from_key[key])}
+        improved_keys = {key for key, effort in effort_from_key.items()
+                         if (key not in self.effort_from_key) or (effort < self.effort_from_key[key])}
+        invalid_atoms = self._invalidate(invalid_keys, self.init_atoms - init_atoms)
+
+        for key in invalid_keys | improved_keys:
+            if key in self.effort_from_key:
+                self._remove_key(key)
+        for key in invalid_keys | improved_keys:
+            if key in effort_from_key:
+                self._add_key(key, result_from_key[key], effort_from_key[key])
+        queue = []
+        for atom in (init_atoms - self.init_atoms) | (invalid_atoms & init_atoms):
+            self.node_from_atom[atom] = Node(0, None)
+            heappush(queue, HeapElement(0, atom))
+        self.init_atoms = init_atoms
+        applied_keys = set(improved_keys) | {key for key in invalid_keys if key in effort_from_key}
+        for atom in invalid_atoms:
+            applied_keys.update(self.keys_from_certified[atom])
+        for key in applied_keys:
+            self._apply(key, queue)
+        while queue:
+            effort, atom = heappop(queue)
+            if (atom not in self.node_from_atom) or (self.node_from_atom[atom].effort < effort):
+                continue
+            for key in list(self.keys_from_condition[atom]):
+                self._apply(key, queue)
+        return {atom: Node(node.effort, None if node.result is None else result_from_key[node.result])
+                for atom, node in self.node_from_atom.items()}
+
 def evaluations_from_stream_plan(evaluations, stream_results, max_effort=INF):
     opt_evaluations = set(evaluations)
     for result in stream_results:
@@ -58,7 +169,20 @@ def evaluations_from_stream_plan(evaluations, stream_results, max_effort=INF):
                               if check_effort(n.effort, max_effort)}
     return result_from_evaluation
 
-def extract_stream_plan(node_from_atom, target_facts, stream_plan):
+def extract_stream_plan(node_from_atom, target_facts, stream_plan, plan_from_fact=None):
+    """
+    Appends the results that (transitively) achieve target_facts to stream_plan
+    :param plan_from_fact: an optional dict that memoizes the stream plan of each fact (see get_plan_from_fact)
+    """
+    if plan_from_fact is not None:
+        # Concatenating the plans of each fact visits results in the same order as the recursion below
+        extracted = set(stream_plan)
+        for fact in target_facts:
+            for result in extract_fact_plan(node_from_atom, fact, plan_from_fact):
+                if result not in extracted:
+                    extracted.add(result)
+                    stream_plan.append(result)
+        return
     # TODO: prune with rules
     # TODO: linearization that takes into account satisfied goals at each level
     # TODO: can optimize for all streams & axioms all at once
@@ -74,3 +198,25 @@ def extract_stream_plan(node_from_atom, target_facts, stream_plan):
             # TODO: dynamic programming version that doesn't reconsider facts
             # TODO: don't add if the fact is already satisfied
             stream_plan.append(result)
+
+def extract_fact_plan(node_from_atom, fact, plan_from_fact):
+    if fact not in plan_from_fact:
+        if fact not in node_from_atom:
+            raise RuntimeError('Preimage fact {} is not achievable!'.format(fact))
+        result = node_from_atom[fact].result
+        stream_plan = []
+        if result is not None:
+            extract_stream_plan(node_from_atom, result.instance.get_domain(), stream_plan, plan_from_fact)
+            if result not in stream_plan:
+                stream_plan.append(result)
+        plan_from_fact[fact] = tuple(stream_plan)
+    return plan_from_fact[fact]
+
+PLAN_FROM_FACT = [] # The node_from_atom and plan_from_fact of the latest extraction
+
+def get_plan_from_fact(node_from_atom):
+    # Reuses the memoized fact plans across passes while node_from_atom is unchanged
+    # node_from_atom is not modified after get_achieving_streams returns it
+    if not PLAN_FROM_FACT or (PLAN_FROM_FACT[0] is not node_from_atom):
+        PLAN_FROM_FACT[:] = [node_from_atom, {}]
+    return PLAN_FROM_FACT[1]
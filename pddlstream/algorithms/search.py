@@ -1,10 +1,11 @@
 from __future__ import print_function
 
-from copy import deepcopy
+from copy import copy
 from time import time
 
-from pddlstream.algorithms.downward import run_search, TEMP_DIR, write_pddl
+from pddlstream.algorithms.downward import run_search, TEMP_DIR, write_pddl, get_temp_dir, DEFAULT_MAX_TIME
 from pddlstream.algorithms.instantiate_task import write_sas_task, translate_and_write_pddl
+from pddlstream.algorithms.python_search import use_python_search, python_search
 from pddlstream.utils import INF, Verbose, safe_rm_dir, elapsed_time
 
 
@@ -16,14 +17,32 @@ from pddlstream.utils import INF, Verbose, safe_rm_dir, elapsed_time
 # TODO: recursive application of these
 # TODO: write the domain and problem PDDL files that are used for debugging purposes
 
-def solve_from_task(sas_task, temp_dir=TEMP_DIR, clean=False, debug=False, hierarchy=[], **search_args):
+def apply_deadline(search_args, deadline=None):
+    # Clamps the planner time to the remaining search budget of the solve
+    if deadline is not None:
+        search_args['max_planner_time'] = deadline.get_planner_time(
+            search_args.get('max_planner_time', DEFAULT_MAX_TIME))
+    return search_args
+
+def solve_from_task(sas_task, temp_dir=TEMP_DIR, clean=False, debug=False, hierarchy=[], deadline=None,
+                    plan_fn=None, terminate_cost=-INF, **search_args):
     # TODO: can solve using another planner and then still translate using FastDownward
     # Can apply plan constraints (skeleton constraints) here as well
+    # plan_fn and terminate_cost are forwarded to the (anytime) search like in run_search
+    apply_deadline(search_args, deadline)
+    if search_args.get('max_planner_time', DEFAULT_MAX_TIME) <= 0:
+        return None, INF # The search budget is exhausted
+    temp_dir = get_temp_dir(temp_dir)
     start_time = time()
     with Verbose(debug):
         print('\n' + 50*'-' + '\n')
-        write_sas_task(sas_task, temp_dir)
-        solution = run_search(temp_dir, debug=True, **search_args)
+        if use_python_search(sas_task, hierarchy=hierarchy, **search_args):
+            solution = python_search(sas_task, debug=True, plan_fn=plan_fn, **search_args)
+        else:
+            if debug:
+                write_sas_task(sas_task, temp_dir)
+            solution = run_search(temp_dir, debug=True, sas_task=sas_task, plan_fn=plan_fn,
+                                  terminate_cost=terminate_cost, **search_args)
         if clean:
             safe_rm_dir(temp_dir)
         print('Total runtime: {:.3f}'.format(elapsed_time(start_time)))
@@ -37,6 +56,7 @@ def solve_from_task(sas_task, temp_dir=TEMP_DIR, clean=False, debug=False, hiera
 def solve_from_pddl(domain_pddl, problem_pddl, temp_dir=TEMP_DIR, clean=False, debug=False, **search_kwargs):
     # TODO: combine with solve_from_task
     #return solve_tfd(domain_pddl, problem_pddl)
+    temp_dir = get_temp_dir(temp_dir)
     start_time = time()
     with Verbose(debug):
         write_pddl(domain_pddl, problem_pddl, temp_dir)
@@ -50,6 +70,95 @@ def solve_from_pddl(domain_pddl, problem_pddl, temp_dir=TEMP_DIR, clean=False, d
 
 ##################################################
 
+def get_task_view(sas_task):
+    # Copy-on-write view that shares the operators, axioms, and mutexes with sas_task
+    # The variables, initial state, and goal are copied because they are small
+    view = copy(sas_task)
+    view.variables = copy(sas_task.variables)
+    view.variables.ranges = list(sas_task.variables.ranges)
+    view.variables.axiom_layers = list(sas_task.variables.axiom_layers)
+    view.variables.value_names = list(sas_task.variables.value_names)
+    view.init = copy(sas_task.init)
+    view.init.values = list(sas_task.init.values)
+    view.goal = copy(sas_task.goal)
+    view.goal.pairs = list(sas_task.goal.pairs)
+    view.operators = list(sas_task.operators)
+    view.axioms = list(sas_task.axioms)
+    return view
+
+
+def modify_operator(sas_task, index):
+    # Replaces the shared operator with a private copy before it is modified
+    operator = copy(sas_task.operators[index])
+    operator.prevail = list(operator.prevail)
+    operator.pre_post = list(operator.pre_post)
+    sas_task.operators[index] = operator
+    return operator
+
+
+def forbid_plan(sas_task, plan):
+    # Reformulation that exactly forbids a single plan (Katz et al. 2018)
+    # A counter tracks the longest followed prefix of the plan until any deviation sets the discarded flag
+    import sas_tasks
+    names = [name_from_action(action, args) for action, args in plan]
+    discarded_var = len(sas_task.variables.ranges)
+    sas_task.variables.ranges.append(2)
+    sas_task.variables.axiom_layers.append(-1)
+    sas_task.variables.value_names.append(['followed{}'.format(discarded_var), 'discarded{}'.format(discarded_var)])
+    sas_task.init.values.append(0)
+
+    step_var = len(sas_task.variables.ranges)
+    step_range = len(names) + 1
+    sas_task.variables.ranges.append(step_range)
+    sas_task.variables.axiom_layers.append(-1)
+    sas_task.variables.value_names.append(['step{}_{}'.format(step_var, i) for i in range(step_range)])
+    sas_task.init.values.append(0)
+
+    for index in range(len(sas_task.operators)):
+        op = modify_operator(sas_task, index)
+        for step in range(step_range):
+            conditions = [(discarded_var, 0), (step_var, step)]
+            if (step < len(names)) and (op.name == names[step]):
+                op.pre_post.append((step_var, -1, step + 1, conditions))
+            else:
+                op.pre_post.append((discarded_var, -1, 1, conditions))
+
+    # The goal is a disjunction: either the plan was discarded or only a strict prefix was followed
+    forbidden_var = len(sas_task.variables.ranges)
+    sas_task.variables.ranges.append(2)
+    sas_task.variables.axiom_layers.append(0)
+    sas_task.variables.value_names.append(['forbidden{}'.format(forbidden_var), 'allowed{}'.format(forbidden_var)])
+    sas_task.init.values.append(0)
+    sas_task.axioms.append(sas_tasks.SASAxiom([(discarded_var, 1)], (forbidden_var, 1)))
+    for step in range(len(names)):
+        sas_task.axioms.append(sas_tasks.SASAxiom([(step_var, step)], (forbidden_var, 1)))
+    sas_task.goal.pairs.append((forbidden_var, 1))
+    return forbidden_var
+
+
+def solve_diverse_from_task(sas_task, num_plans=1, max_planner_time=DEFAULT_MAX_TIME, debug=False, **search_args):
+    """
+    Solves the SAS+ task num_plans times while forbidding each previously returned plan
+    :return: a list of (plan, cost) tuples in the order that they were found
+    """
+    start_time = time()
+    sas_task = get_task_view(sas_task) # forbid_plan modifies the variables, operators, and goal
+    solutions = []
+    while len(solutions) < num_plans:
+        remaining_time = max_planner_time - elapsed_time(start_time)
+        if remaining_time <= 0:
+            break
+        plan, cost = solve_from_task(sas_task, max_planner_time=remaining_time, debug=debug, **search_args)
+        if plan is None:
+            break
+        solutions.append((plan, cost))
+        forbid_plan(sas_task, plan)
+    print('Plans: {} | Costs: {} | Runtime: {:.3f}'.format(
+        len(solutions), [round(cost, 3) for _, cost in solutions], elapsed_time(start_time)))
+    return solutions
+
+##################################################
+
 def apply_sas_operator(init, op):
     for var, pre, post, cond in op.pre_post:
         assert (pre == -1) or (init.values[var] == pre)
@@ -72,13 +181,12 @@ def parse_sas_plan(sas_task, plan):
 
 SERIALIZE = 'serialize'
 
-def plan_subgoals(sas_task, subgoal_plan, temp_dir, **kwargs):
+def plan_subgoals(sas_task, subgoal_plan, temp_dir, deadline=None, **kwargs):
     full_plan = []
     full_cost = 0
     for subgoal in subgoal_plan:
         sas_task.goal.pairs = subgoal
-        write_sas_task(sas_task, temp_dir)
-        plan, cost = run_search(temp_dir, debug=True, **kwargs)
+        plan, cost = run_search(temp_dir, debug=True, sas_task=sas_task, **apply_deadline(kwargs, deadline))
         if plan is None:
             return None, INF
         full_plan.extend(plan)
@@ -88,14 +196,17 @@ def plan_subgoals(sas_task, subgoal_plan, temp_dir, **kwargs):
     return full_plan, full_cost
 
 
-def serialized_solve_from_task(sas_task, temp_dir=TEMP_DIR, clean=False, debug=False, hierarchy=[], **kwargs):
+def serialized_solve_from_task(sas_task, temp_dir=TEMP_DIR, clean=False, debug=False, hierarchy=[], deadline=None,
+                               **kwargs):
     # TODO: specify goal grouping / group by predicate & objects
     # TODO: version that solves for all disjuctive subgoals at once
+    temp_dir = get_temp_dir(temp_dir)
+    sas_task = get_task_view(sas_task) # plan_subgoals modifies the goal and initial state
     start_time = time()
     with Verbose(debug):
         print('\n' + 50*'-' + '\n')
         subgoal_plan = [sas_task.goal.pairs[:i+1] for i in range(len(sas_task.goal.pairs))]
-        plan, cost = plan_subgoals(sas_task, subgoal_plan, temp_dir, **kwargs)
+        plan, cost = plan_subgoals(sas_task, subgoal_plan, temp_dir, deadline=deadline, **kwargs)
         if clean:
             safe_rm_dir(temp_dir)
         print('Total runtime: {:.3f}'.format(elapsed_time(start_time)))
@@ -130,13 +241,11 @@ def prune_hierarchy_pre_eff(sas_task, layers):
         for val, name in enumerate(names):
             if any(name.startswith(p) for p in pruned_pre):
                 pruned.add((var, val))
-    for op in sas_task.operators:
-        for k, pair in reversed(list(enumerate(op.prevail))):
-            if pair in pruned:
-                op.prevail.pop(0)
-    for k, pair in reversed(list(enumerate(sas_task.goal.pairs))):
-        if pair in pruned:
-            sas_task.goal.pairs.pop(0)
+    for index, op in enumerate(sas_task.operators):
+        if any(pair in pruned for pair in op.prevail):
+            op = modify_operator(sas_task, index)
+            op.prevail[:] = [pair for pair in op.prevail if pair not in pruned]
+    sas_task.goal.pairs[:] = [pair for pair in sas_task.goal.pairs if pair not in pruned]
     return pruned
 
 
@@ -158,6 +267,7 @@ def add_subgoals(sas_task, subgoal_plan):
             continue
         subgoal = subgoal_plan.index(op.name) + 1
         pre_post = (subgoal_var, subgoal - 1, subgoal, [])
+        op = modify_operator(sas_task, i)
         op.pre_post.append(pre_post)
         # TODO: maybe this should be the resultant state instead?
         # TODO: prevail should just be the last prevail
@@ -168,25 +278,29 @@ def add_subgoals(sas_task, subgoal_plan):
     return subgoal_var
 
 
-def abstrips_solve_from_task(sas_task, temp_dir=TEMP_DIR, clean=False, debug=False, hierarchy=[], **kwargs):
+def abstrips_solve_from_task(sas_task, temp_dir=TEMP_DIR, clean=False, debug=False, hierarchy=[], deadline=None,
+                             **kwargs):
     # Like partial order planning in terms of precondition order
     # TODO: add achieve subgoal actions
     # TODO: most generic would be a heuristic on each state
     if hierarchy == SERIALIZE:
-        return serialized_solve_from_task(sas_task, temp_dir=temp_dir, clean=clean, debug=debug, **kwargs)
+        return serialized_solve_from_task(sas_task, temp_dir=temp_dir, clean=clean, debug=debug,
+                                          deadline=deadline, **kwargs)
     if not hierarchy:
-        return solve_from_task(sas_task, temp_dir=temp_dir, clean=clean, debug=debug, **kwargs)
+        return solve_from_task(sas_task, temp_dir=temp_dir, clean=clean, debug=debug, deadline=deadline, **kwargs)
+    temp_dir = get_temp_dir(temp_dir)
     start_time = time()
     plan, cost = None, INF
     with Verbose(debug):
         print('\n' + 50*'-' + '\n')
         last_plan = []
         for level in range(len(hierarchy)+1):
-            local_sas_task = deepcopy(sas_task)
+            local_sas_task = get_task_view(sas_task)
             prune_hierarchy_pre_eff(local_sas_task, hierarchy[level:]) # TODO: break if no pruned
             add_subgoals(local_sas_task, last_plan)
-            write_sas_task(local_sas_task, temp_dir)
-            plan, cost = run_search(temp_dir, debug=True, **kwargs)
+            if debug:
+                write_sas_task(local_sas_task, temp_dir)
+            plan, cost = run_search(temp_dir, debug=True, sas_task=local_sas_task, **apply_deadline(kwargs, deadline))
             if (level == len(hierarchy)) or (plan is None):
                 # TODO: fall back on standard search
                 break
@@ -203,17 +317,18 @@ def abstrips_solve_from_task(sas_task, temp_dir=TEMP_DIR, clean=False, debug=Fal
 # Each operator in the hierarchy is a legal "operator" that may need to be refined
 
 def abstrips_solve_from_task_sequential(sas_task, temp_dir=TEMP_DIR, clean=False, debug=False,
-                                        hierarchy=[], subgoal_horizon=1, **kwargs):
+                                        hierarchy=[], subgoal_horizon=1, deadline=None, **kwargs):
     # TODO: version that plans for each goal individually
     # TODO: can reduce to goal serialization if binary flag for each subgoal
     if not hierarchy:
-        return solve_from_task(sas_task, temp_dir=temp_dir, clean=clean, debug=debug, **kwargs)
+        return solve_from_task(sas_task, temp_dir=temp_dir, clean=clean, debug=debug, deadline=deadline, **kwargs)
+    temp_dir = get_temp_dir(temp_dir)
     start_time = time()
     plan, cost = None, INF
     with Verbose(debug):
         last_plan = None
         for level in range(len(hierarchy) + 1):
-            local_sas_task = deepcopy(sas_task)
+            local_sas_task = get_task_view(sas_task)
             prune_hierarchy_pre_eff(local_sas_task, hierarchy[level:])  # TODO: break if no pruned
             # The goal itself is effectively a subgoal
             # Handle this subgoal horizon
@@ -225,7 +340,7 @@ def abstrips_solve_from_task_sequential(sas_task, temp_dir=TEMP_DIR, clean=False
                     local_sas_task.variables.ranges[subgoal_var], subgoal_horizon)] + subgoal_plan
                 hierarchy_horizon = min(hierarchy[level-1].horizon, len(subgoal_plan))
                 subgoal_plan = subgoal_plan[:hierarchy_horizon]
-            plan, cost = plan_subgoals(local_sas_task, subgoal_plan, temp_dir, **kwargs)
+            plan, cost = plan_subgoals(local_sas_task, subgoal_plan, temp_dir, deadline=deadline, **kwargs)
             if (level == len(hierarchy)) or (plan is None):
                 # TODO: fall back on normal
                 # TODO: search in space of subgoals
@@ -10,6 +10,7 @@ from pddlstream.algorithms.common import is_instance_ready, compute_complexity,
 from pddlstream.language.conversion import evaluation_from_fact
 from pddlstream.algorithms.disabled import process_instance, update_bindings, update_cost, bind_action_plan
 from pddlstream.algorithms.reorder import get_output_objects, get_object_orders, get_partial_orders, get_initial_orders
+from pddlstream.algorithms.scheduling.recover_streams import get_result_key
 from pddlstream.language.constants import is_plan, INFEASIBLE, FAILED, SUCCEEDED
 from pddlstream.language.function import FunctionResult
 from pddlstream.algorithms.visualization import visualize_stream_orders
@@ -21,6 +22,7 @@ USE_PRIORITIES = True
 GREEDY_VISITS = 0
 GREEDY_BEST = True
 REQUIRE_DOWNSTREAM = True
+PRUNE_DOMINATED = True # Prunes skeletons and bindings whose remaining stream plans are dominated
 
 Priority = namedtuple('Priority', ['not_greedy', 'complexity', 'visits', 'remaining', 'cost']) # TODO: FIFO
 Affected = namedtuple('Affected', ['indices', 'has_cost'])
@@ -57,6 +59,8 @@ class Skeleton(object):
         self.cost = cost
         self.best_binding = None
         self.improved = False
+        self.dominated = False
+        self.result_keys = frozenset(map(get_result_key, self.stream_plan))
         self.root = Binding(self, self.cost, history=[], mapping={}, index=0, parent=None, parent_result=None)
         self.affected_indices = [compute_affected_downstream(self.stream_plan, index)
                                  for index in range(len(self.stream_plan))]
@@ -95,6 +99,10 @@ class Skeleton(object):
             self.improved = True
             return True
         return False
+    def dominates(self, result_keys, cost):
+        # Every binding of a superset skeleton samples the streams of this skeleton (which share instances)
+        # Functions are optimistic lower bounds, so the additional streams can only increase the cost
+        return (not self.dominated) and (self.cost <= cost) and (self.result_keys <= result_keys)
     def bind_stream_result(self, index, mapping):
         return self.stream_plan[index].remap_inputs(mapping) # Has optimistic output objects
     def bind_action_plan(self, mapping):
@@ -122,7 +130,9 @@ class Binding(object):
         self.parent_result = parent_result
 
         self.children = []
+        self.pruned = False
         self._result = False
+        self.remaining_key = None
         self.visits = 0 # The number of times _process_binding has been called
         self.calls = 0 # The index for result_history
         self.complexity = None
@@ -143,7 +153,20 @@ class Binding(object):
     def is_best(self):
         return self.skeleton.best_binding is self
     def is_dominated(self):
-        return self.skeleton.queue.store.best_cost <= self.cost
+        return self.pruned or self.skeleton.dominated or (self.skeleton.queue.store.best_cost <= self.cost)
+    def get_remaining_key(self):
+        # Bindings with the same remaining (bound) stream plan succeed or fail together
+        # and, with the same (bound) action plan, have the same remaining function and action costs
+        if self.remaining_key is None:
+            action_plan = tuple(self.skeleton.bind_action_plan(self.mapping).action_plan)
+            self.remaining_key = (action_plan, frozenset(
+                get_result_key(self.skeleton.bind_stream_result(index, self.mapping))
+                for index in range(self.index, len(self.skeleton.stream_plan))))
+        return self.remaining_key
+    def prune(self):
+        # Descendants that were already expanded would otherwise remain in the queue
+        for binding in self.post_order():
+            binding.pruned = True
     def is_enumerated(self):
         return self.is_fully_bound or self.result.enumerated
     def is_unsatisfied(self):
@@ -263,6 +286,9 @@ class SkeletonQueue(Sized):
         self.queue = [] # TODO: deque version
         self.disable = disable
         self.standby = []
+        self.binding_from_key = {}
+        self.new_fn = None # Called once sampling has added new evaluations (see process)
+        self.num_evaluations = 0
 
     @property
     def evaluations(self):
@@ -291,10 +317,38 @@ class SkeletonQueue(Sized):
         priority, binding = self.queue[0]
         return priority, binding
 
+    def prune_dominated(self, binding):
+        # The remaining cost of bindings with the same remaining stream plan and action plan is identical
+        if not PRUNE_DOMINATED or not self.disable or binding.is_fully_bound:
+            return False
+        key = binding.get_remaining_key()
+        other = self.binding_from_key.get(key, None)
+        if (other is not None) and (not other.is_dominated()) and (other.cost <= binding.cost):
+            binding.pruned = True
+            return True
+        if other is not None:
+            other.prune()
+        self.binding_from_key[key] = binding
+        return False
+
+    def forget_binding(self, binding):
+        # Bounds binding_from_key by the bindings that can still be expanded
+        if binding.remaining_key is None:
+            return
+        key = binding.get_remaining_key()
+        if self.binding_from_key.get(key, None) is binding:
+            del self.binding_from_key[key]
+
     def new_skeleton(self, stream_plan, action_plan, cost):
         skeleton = Skeleton(self, stream_plan, action_plan, cost)
+        if PRUNE_DOMINATED and self.disable: # Disabled axioms are derived from every skeleton
+            for other in self.skeletons:
+                if skeleton.dominates(other.result_keys, other.cost) and \
+                        not other.dominates(skeleton.result_keys, skeleton.cost): # Keeps the first duplicate
+                    other.dominated = True
         self.skeletons.append(skeleton)
-        self.push_binding(skeleton.root)
+        if not self.prune_dominated(skeleton.root):
+            self.push_binding(skeleton.root)
         #self.greedily_process()
         return skeleton
 
@@ -303,12 +357,18 @@ class SkeletonQueue(Sized):
             self.push_binding(binding)
         self.standby = []
 
+    def check_new(self):
+        if (self.new_fn is not None) and (self.num_evaluations < len(self.evaluations)):
+            new_fn, self.new_fn = self.new_fn, None
+            new_fn()
+
     #########################
 
     def _process_binding(self, binding):
         assert binding.calls <= binding.visits # TODO: global DEBUG mode
         readd = is_new = False
         if binding.is_dominated():
+            self.forget_binding(binding)
             return readd, is_new
         if binding.is_fully_bound:
             action_plan = binding.skeleton.bind_action_plan(binding.mapping)
@@ -327,9 +387,13 @@ class SkeletonQueue(Sized):
         if binding.up_to_date():
             new_results, _ = process_instance(self.store, self.domain, instance, disable=self.disable)
             is_new = bool(new_results)
+            self.check_new()
         for new_binding in binding.update_bindings():
-            self.push_binding(new_binding)
+            if not self.prune_dominated(new_binding):
+                self.push_binding(new_binding)
         readd = not instance.enumerated
+        if not readd:
+            self.forget_binding(binding)
         return readd, is_new
 
     #########################
@@ -425,7 +489,16 @@ class SkeletonQueue(Sized):
                 add_certified(self.evaluations, result, **kwargs) # TODO: should special have a complexity of INF?
         # TODO: AssertionError: Could not find instantiation for numeric expression: dist
 
-    def process(self, stream_plan, action_plan, cost, complexity_limit, max_time=0, accelerate=False):
+    def process(self, stream_plan, action_plan, cost, complexity_limit, max_time=0, accelerate=False, new_fn=None):
+        # new_fn is called (at most once) as soon as sampling adds evaluations that the last search did not observe
+        self.new_fn, self.num_evaluations = new_fn, len(self.evaluations)
+        try:
+            return self._process(stream_plan, action_plan, cost, complexity_limit,
+                                 max_time=max_time, accelerate=accelerate)
+        finally:
+            self.new_fn = None
+
+    def _process(self, stream_plan, action_plan, cost, complexity_limit, max_time=0, accelerate=False):
         start_time = time.time()
         if is_plan(stream_plan):
             self.new_skeleton(stream_plan, action_plan, cost)
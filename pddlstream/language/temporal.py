@@ -3,17 +3,19 @@ from __future__ import print_function
 #from os.path import expanduser
 import os
 import re
-import subprocess
+import shlex
 import time
 import sys
 import traceback
 
 from collections import namedtuple
 
-from pddlstream.algorithms.downward import TEMP_DIR, DOMAIN_INPUT, PROBLEM_INPUT, make_effects, \
-    parse_sequential_domain, get_conjunctive_parts, write_pddl, make_action, make_parameters, make_object, fd_from_fact, Domain, make_effects
+from pddlstream.algorithms.downward import get_temp_dir, MAX_PLANNER_MEMORY, DOMAIN_INPUT, PROBLEM_INPUT, make_effects, \
+    parse_sequential_domain, get_conjunctive_parts, write_pddl, make_action, make_parameters, make_object, fd_from_fact, Domain, make_effects, \
+    load_translator
 from pddlstream.language.constants import DurativeAction, Fact, Not
-from pddlstream.utils import INF, ensure_dir, write, user_input, safe_rm_dir, read, elapsed_time, find_unique, safe_zip
+from pddlstream.utils import INF, ensure_dir, write, user_input, safe_rm_dir, read, elapsed_time, find_unique, safe_zip, \
+    ExternalProcess
 
 PLANNER = 'tfd' # tfd | tflap | optic | tpshe | cerberus
 
@@ -395,6 +397,7 @@ def get_tfd_path():
     return os.path.join(os.environ[ENV_VAR], 'downward/')
 
 def parse_temporal_domain(domain_pddl):
+    load_translator() # The sequential translator's modules are restored below
     translate_path = os.path.join(get_tfd_path(), 'translate/') # tfd & temporal-FD
     prefixes = ['pddl', 'normalize']
     deleted = delete_imports(prefixes)
@@ -622,7 +625,10 @@ def sequential_from_temporal_plan(plan):
 
 ##################################################
 
-def solve_tfd(domain_pddl, problem_pddl, planner=TFD_OPTIONS, max_planner_time=60, debug=False, **kwargs):
+def solve_tfd(domain_pddl, problem_pddl, planner=TFD_OPTIONS, max_planner_time=60, debug=False, deadline=None,
+              process_usages=None, **kwargs):
+    if deadline is not None:
+        max_planner_time = deadline.get_planner_time(max_planner_time)
     if PLANNER == 'tfd':
         root = get_tfd_path()
         # TODO: make a function for this
@@ -640,29 +646,33 @@ def solve_tfd(domain_pddl, problem_pddl, planner=TFD_OPTIONS, max_planner_time=6
         raise ValueError(PLANNER)
 
     start_time = time.time()
-    domain_path, problem_path = write_pddl(domain_pddl, problem_pddl)
-    plan_path = os.path.join(TEMP_DIR, PLAN_FILE)
+    temp_path = get_temp_dir() # Absolute path
+    domain_path, problem_path = write_pddl(domain_pddl, problem_pddl, temp_path)
+    plan_path = os.path.join(temp_path, PLAN_FILE)
     #assert not actions, "There shouldn't be any actions - just temporal actions"
 
-    paths = [os.path.join(os.getcwd(), p) for p in (domain_path, problem_path, plan_path)]
+    paths = [domain_path, problem_path, plan_path]
     command = os.path.join(root, template.format(*paths))
     print(command)
     if debug:
         stdout, stderr = None, None
     else:
         stdout, stderr = open(os.devnull, 'w'), open(os.devnull, 'w')
-    proc = subprocess.call(command, shell=True, cwd=root, stdout=stdout, stderr=stderr) # timeout=None (python3)
-    error = proc != 0
+    # Only OPTIC_COMMAND requires a shell (to pipe through tee), whose usage excludes the planner if it is killed
+    shell = (PLANNER == 'optic')
+    proc = ExternalProcess(command if shell else shlex.split(command), name=PLANNER, max_time=max_planner_time,
+                           max_memory=MAX_PLANNER_MEMORY, usages=process_usages, shell=shell, cwd=root,
+                           stdout=stdout, stderr=stderr)
+    error = proc.wait() != 0
     print('Error:', error)
     # TODO: returns an error when no plan was found
     # TODO: close any opened resources
 
-    temp_path = os.path.join(os.getcwd(), TEMP_DIR)
     plan_files = sorted(f for f in os.listdir(temp_path) if f.startswith(PLAN_FILE))
     print('Plans:', plan_files)
     best_plan, best_makespan = parse_plans(temp_path, plan_files)
     #if not debug:
-    #    safe_rm_dir(TEMP_DIR)
+    #    safe_rm_dir(temp_path)
     print('Makespan: ', best_makespan)
     print('Time:', elapsed_time(start_time))
 
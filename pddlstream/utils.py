@@ -4,7 +4,10 @@ import math
 import os
 import pickle
 import shutil
+import signal
+import subprocess
 import sys
+import threading
 import time
 import random
 import cProfile
@@ -243,6 +246,105 @@ def check_memory(max_memory):
 
 ##################################################
 
+WATCHDOG_SLACK = 5 # Seconds past max_time before an external process is killed
+PROCESS_PERIOD = 1e-2 # Seconds between polls
+
+ProcessUsage = namedtuple('ProcessUsage', ['name', 'wall_time', 'cpu_time', 'peak_memory', 'returncode', 'killed'])
+
+def get_preexec_fn(max_time=INF, max_memory=INF):
+    # Runs in the child between fork and exec, so the limits apply before the command starts
+    # Only performs system calls, as the child might otherwise deadlock on locks held by the parent's other threads
+    try:
+        import resource # Unix only
+    except ImportError:
+        resource = None
+    limits = []
+    if (resource is not None) and (max_time != INF):
+        limits.append((resource.RLIMIT_CPU, int_ceil(max_time + WATCHDOG_SLACK))) # Seconds
+    if (resource is not None) and (max_memory != INF):
+        limits.append((resource.RLIMIT_AS, int(max_memory * BYTES_PER_KILOBYTE))) # Bytes
+    def preexec_fn():
+        os.setsid() # New session (and thus process group) so that the command's children are also killed
+        for limit, value in limits:
+            try:
+                _, hard = resource.getrlimit(limit)
+                if hard != resource.RLIM_INFINITY:
+                    value = min(value, hard)
+                resource.setrlimit(limit, (value, hard))
+            except (OSError, ValueError): # The watchdog still applies
+                pass
+    return preexec_fn
+
+
+class ExternalProcess(object):
+    """
+    Wraps subprocess.Popen with resource limits, a wall-clock watchdog, process-group kills,
+    and records the process's resource usage in usages when not None
+    The usage includes the command's children that it waited for but excludes those killed along with it,
+    so commands should be executed directly (without a shell) whenever possible
+    """
+    def __init__(self, command, name=None, max_time=INF, max_memory=INF, usages=None, **kwargs):
+        self.name = name
+        self.max_time = max_time
+        self.usages = usages
+        self.start_time = time.time()
+        self.proc = subprocess.Popen(command, preexec_fn=get_preexec_fn(max_time, max_memory), **kwargs)
+        self.killed = False
+        self.usage = None
+    @property
+    def pid(self):
+        return self.proc.pid
+    @property
+    def stdin(self):
+        return self.proc.stdin
+    @property
+    def returncode(self):
+        return self.proc.returncode
+    def elapsed_time(self):
+        return elapsed_time(self.start_time)
+    def reap(self, block=False):
+        if self.usage is not None:
+            return True
+        try:
+            pid, status, rusage = os.wait4(self.pid, 0 if block else os.WNOHANG)
+        except OSError: # Already reaped
+            self.proc.wait()
+            pid, status, rusage = self.pid, None, None
+        if pid == 0:
+            return False
+        if status is not None:
+            self.proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        cpu_time = INF if rusage is None else (rusage.ru_utime + rusage.ru_stime)
+        peak_memory = INF if rusage is None else rusage.ru_maxrss # KB on Linux
+        self.usage = ProcessUsage(self.name, self.elapsed_time(), cpu_time, peak_memory,
+                                  self.returncode, self.killed)
+        if self.usages is not None:
+            self.usages.append(self.usage)
+        return True
+    def kill(self):
+        if not self.reap():
+            self.killed = True
+            try:
+                os.killpg(self.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            self.reap(block=True)
+        return self.returncode
+    def poll(self):
+        # Also serves as the watchdog
+        if not self.reap() and ((self.max_time + WATCHDOG_SLACK) <= self.elapsed_time()):
+            print('Killing {} after {:.3f} seconds'.format(self.name, self.elapsed_time()))
+            self.kill()
+        return self.returncode
+    def wait(self, period=PROCESS_PERIOD):
+        while self.poll() is None:
+            sleep_unlocked(period)
+        return self.returncode
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.name)
+
+##################################################
+
 class Saver(object):
     # TODO: contextlib
     def save(self):
@@ -278,22 +380,133 @@ class Profiler(Saver):
         return stats
 
 
+class SharedLock(object):
+    """
+    A reentrant lock that threads acquire in first-come first-served order,
+    so a thread that repeatedly releases and reacquires it cannot starve the others
+    """
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.owner = None
+        self.depth = 0
+        self.next_ticket = self.serving = 0
+    def owned(self):
+        return self.owner is threading.current_thread()
+    def acquire(self, depth=1):
+        with self.condition:
+            if self.owned():
+                self.depth += depth
+                return
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            while self.serving != ticket:
+                self.condition.wait()
+            self.owner, self.depth = threading.current_thread(), depth
+    def release(self, depth=1):
+        with self.condition:
+            assert self.owned() and (depth <= self.depth)
+            self.depth -= depth
+            if self.depth == 0:
+                self.owner = None
+                self.serving += 1
+                self.condition.notify_all()
+    def suspend(self):
+        # Fully releases the lock and returns the depth to resume (0 if not owned)
+        if not self.owned():
+            return 0
+        depth = self.depth
+        self.release(depth)
+        return depth
+    def resume(self, depth):
+        if depth:
+            self.acquire(depth)
+    def __enter__(self):
+        self.acquire()
+        return self
+    def __exit__(self, type, value, traceback):
+        self.release()
+
+
+# Held by the thread whose Python code mutates solve state while a search runs in the background
+SOLVE_LOCK = SharedLock()
+
+class Unlocked(Saver):
+    # Lets the other threads hold the lock while this thread waits (e.g. on a subprocess)
+    def __init__(self, lock=SOLVE_LOCK):
+        self.lock = lock
+    def save(self):
+        self.depth = self.lock.suspend()
+    def restore(self):
+        self.lock.resume(self.depth)
+
+def sleep_unlocked(period, lock=SOLVE_LOCK):
+    with Unlocked(lock):
+        time.sleep(period)
+
+
+class ThreadOutput(object):
+    """
+    Stands in for sys.stdout and forwards each thread's output to its own stream,
+    so that a thread can silence itself without silencing the others (see Verbose)
+    """
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+    @property
+    def stream(self):
+        return getattr(self.local, 'stream', None) or self.stdout
+    def redirect(self, stream):
+        # Returns the previous stream of this thread (None for the shared stdout)
+        previous = getattr(self.local, 'stream', None)
+        self.local.stream = stream
+        return previous
+    def write(self, string):
+        return self.stream.write(string)
+    def flush(self):
+        return self.stream.flush()
+    def __getattr__(self, attribute):
+        return getattr(self.stream, attribute)
+
+def install_thread_output():
+    # Returns the installed ThreadOutput (None if one was already installed)
+    if isinstance(sys.stdout, ThreadOutput):
+        return None
+    sys.stdout = ThreadOutput(sys.stdout)
+    return sys.stdout
+
+def uninstall_thread_output(output):
+    if (output is not None) and (sys.stdout is output):
+        sys.stdout = output.stdout
+
+def is_main_thread():
+    return isinstance(threading.current_thread(), threading._MainThread) # threading.main_thread() is Python 3
+
+
 class Verbose(Saver): # TODO: use DisableOutput
+    # Only silences the current thread when sys.stdout is a ThreadOutput
     def __init__(self, verbose=False):
         self.verbose = verbose
     def save(self):
         if self.verbose:
             return
-        self.stdout = sys.stdout
         self.devnull = open(os.devnull, 'w')
-        sys.stdout = self.devnull
+        self.output = sys.stdout if isinstance(sys.stdout, ThreadOutput) else None
+        self.stdout = None
+        if self.output is not None:
+            self.stdout = self.output.redirect(self.devnull)
+        elif is_main_thread(): # Replacing sys.stdout from another thread would silence the main thread
+            self.stdout = sys.stdout
+            sys.stdout = self.devnull
         #self.stderr = sys.stderr
         #self.devnull = open(os.devnull, 'w')
         #sys.stderr = self.stderr
     def restore(self):
         if self.verbose:
             return
-        sys.stdout = self.stdout
+        if self.output is not None:
+            self.output.redirect(self.stdout)
+        elif self.stdout is not None:
+            sys.stdout = self.stdout
         self.devnull.close()
         #sys.stderr = self.stderr
         #self.devnull.close()